@@ -10,30 +10,32 @@ This code is similar to 'GeCo: Quality Counterfactual Explanations in Real Time'
 
 """
 import copy
+import itertools
+import logging
+import numbers
+import os
 import random
+import re
 import timeit
+from collections import OrderedDict
+from datetime import datetime
+
 import numpy as np
 import pandas as pd
-import os
+from joblib import Parallel, delayed, effective_n_jobs
+from scipy.spatial.distance import _validate_vector, cdist, pdist
+from scipy.stats import median_abs_deviation
+
 from dice_ml import diverse_counterfactuals as exp
 from dice_ml.constants import ModelTypes
 from dice_ml.explainer_interfaces.explainer_base import ExplainerBase
+from dice_ml.utils import _dist_numba
 from dice_ml.utils.exception import UserConfigValidationException
-import pm4py
-from declare4py.declare4py import Declare4Py
-from declare4py.enums import TraceState
-import re
-from scipy.spatial.distance import _validate_vector
-from scipy.spatial.distance import cdist, pdist
-from scipy.stats import median_abs_deviation
-
-import itertools
-from datetime import datetime
 
-import logging
 logger = logging.getLogger(__name__)
-from pm4py.objects.conversion.log import converter as log_converter 
-from utilities.dataframe_operations import find_activity_position_by_name
+
+# wide prefix columns are turned into an event log with these case id and activity columns
+_COLUMNS_TO_RENAME = {'Case ID': 'case:concept:name', 'prefix': 'concept:name'}
 
 class DiceGeneticConformance(ExplainerBase):
 
@@ -48,15 +50,85 @@ class DiceGeneticConformance(ExplainerBase):
 
         # variables required to generate CFs - see generate_counterfactuals() for more info
         self.cfs = []
+        # set for every query by _generate_counterfactuals()
+        self.population_size = 0
         self.features_to_vary = []
         self.cf_init_weights = []  # total_CFs, algorithm, features_to_vary
         self.loss_weights = []  # yloss_type, diversity_loss_type, feature_weights
         self.feature_weights_input = ''
+        # feature weight lists keyed by weight values and encoding, see do_loss_initializations(), and the
+        # training-data MADs
+        self._fw_cache = {}
+        self._fw_cache_size = 8
+        self._cached_mads = None
 
         # Initializing a label encoder to obtain label-encoded values for categorical variables
         self.labelencoder = set()
+        # classes_ of the label encoders in _inv_table_owner, indexed by label, see _get_inverse_table()
+        self._inv_table = {}
+        self._inv_table_owner = None
         self.predicted_outcome_name = self.data_interface.outcome_name + '_pred'
 
+        # prefix_<suffix> activity columns in event order, and their suffixes, see _wide_to_long(); like
+        # pd.wide_to_long(..., suffix=r'\w+'), the suffixes are ordered as numbers when they all are numeric
+        # and as strings otherwise
+        prefix_cols = [feature for feature in self.data_interface.feature_names
+                       if re.fullmatch(r'prefix_\w+', feature)]
+        prefix_order = pd.Series([feature[len('prefix_'):] for feature in prefix_cols], dtype=object)
+        try:
+            prefix_order = pd.to_numeric(prefix_order)
+        except ValueError:
+            pass
+        sort_index = np.argsort(prefix_order.to_numpy(), kind='stable')
+        self._prefix_cols = [prefix_cols[ix] for ix in sort_index]
+        self._prefix_order = prefix_order.to_numpy()[sort_index]
+        # column index shared by every DataFrame handed to the model
+        self._feature_index = pd.Index(self.data_interface.feature_names)
+        # whether each feature, in feature_names order, is continuous
+        continuous_features = set(self.data_interface.continuous_feature_names)
+        self._is_continuous = np.array([feature in continuous_features
+                                        for feature in self.data_interface.feature_names], dtype=bool)
+        # one-hot columns of the training data, used to align the query with the KD tree
+        self._all_dummy_colnames = pd.Index(self.data_interface.get_all_dummy_colnames())
+        # per-query arrays used to sample random initializations, see _build_random_init_cache()
+        self._rand_init_cache = None
+        # (training data, MADs of its continuous features, their inverses), see _get_continuous_mads()
+        self._cont_mads = None
+        # (training data, array copy of it), see _get_training_array()
+        self._X_y_np = None
+        self.n_jobs = 1
+        # joblib.Parallel running the conformance workers of the current query, see _start_conformance_pool()
+        self._pool = None
+        # source of all the randomness of the search, reseeded by _generate_counterfactuals()
+        self._rng = np.random.default_rng()
+        # LRU of model scores keyed by the bytes of a population row, see _predict_scores_cached()
+        self._scores_cache = OrderedDict()
+        # parsed declare models keyed by (path, mtime) of the .decl file, see _load_declare_model()
+        self._d4py_cache = {}
+        # (declare model pruned by filter_declare_model, its constraint activities) for the
+        # (.decl file, query, encoder) in _pruned_model_key
+        self._pruned_model_key = None
+        self._pruned_model = None
+        # buffer every next generation is written to, see _allocate_population_buffer()
+        self._pop_buffer = None
+        # build_KD_tree outputs keyed by (desired_class, desired_range), for the training data in
+        # _kd_cache_data_key, see _get_KD_tree()
+        self._kd_cache = {}
+        self._kd_cache_data_key = None
+        # running (exponential moving average) acceptance rate of random initializations and the bounds
+        # of the batches sampled from it, see do_random_init()
+        self._accept_rate_estimate = 1.0
+        self._min_init_batch_size = 256
+        self._max_init_oversampling = 64
+        # (score, case key, position in the evaluated batch, checker results) keyed by the bytes of a population
+        # row, valid for the (declare model, encoder, penalty settings) in _conf_cache_owner
+        self._conf_cache = {}
+        self._conf_cache_owner = None
+        # plausibility loss keyed by the bytes of a population row, valid for the (query, training data) in
+        # _plaus_cache_owner, see _memoized_plausibility()
+        self._plaus_cache = {}
+        self._plaus_cache_owner = None
+
     def update_hyperparameters(self, proximity_weight, sparsity_weight,plausibility_weight,
                                diversity_weight, categorical_penalty,conformance_weight):
         """Update hyperparameters of the loss function"""
@@ -76,14 +148,26 @@ class DiceGeneticConformance(ExplainerBase):
         self.yloss_type = yloss_type
         self.diversity_loss_type = diversity_loss_type
         # define feature weights
-        if feature_weights != self.feature_weights_input:
-            self.feature_weights_input = feature_weights
-            if feature_weights == "inverse_mad":
-                normalized_mads = self.data_interface.get_valid_mads(normalized=False)
-                feature_weights = {}
-                for feature in normalized_mads:
-                    feature_weights[feature] = round(1 / normalized_mads[feature], 2)
-
+        self.feature_weights_input = feature_weights
+        if feature_weights == "inverse_mad":
+            if self._cached_mads is None:
+                self._cached_mads = self.data_interface.get_valid_mads(normalized=False)
+            normalized_mads = self._cached_mads
+            feature_weights = {}
+            for feature in normalized_mads:
+                feature_weights[feature] = round(1 / normalized_mads[feature], 2)
+
+        # the list only depends on the weight values, the encoding and, for label encoding, the maximum of the
+        # ranges of the unweighted features, so it is keyed by value and reused for the following queries
+        range_max = ()
+        if encoding == 'label':
+            range_max = tuple(np.max(self.feature_range[feature]) for feature in self.data_interface.feature_names
+                              if feature not in feature_weights)
+        weights_key = tuple(sorted(feature_weights.items())) if isinstance(feature_weights, dict) else feature_weights
+        cache_key = (weights_key, encoding, range_max)
+        if cache_key in self._fw_cache:
+            self.feature_weights_list = [self._fw_cache[cache_key]]
+        else:
             feature_weights_list = []
             if encoding == 'one-hot':
                 for feature in self.data_interface.encoded_feature_names:
@@ -98,7 +182,22 @@ class DiceGeneticConformance(ExplainerBase):
                     else:
                         # the weight is inversely proportional to max value
                         feature_weights_list.append(round(1 / self.feature_range[feature].max(), 2))
+            if len(self._fw_cache) >= self._fw_cache_size:
+                del self._fw_cache[next(iter(self._fw_cache))]
+            self._fw_cache[cache_key] = feature_weights_list
             self.feature_weights_list = [feature_weights_list]
+        # indexes and normalized weights of the continuous features, as used by compute_proximity_loss
+        self._cont_idx = np.asarray(self.data_interface.continuous_feature_indexes, dtype=np.intp)
+        cont_feature_weights = np.asarray(self.feature_weights_list[0], dtype=float)[self._cont_idx]
+        self._fw_norm = cont_feature_weights / cont_feature_weights.sum()
+        # min and inverse range of the continuous features, for the normalization done by the numba kernel
+        self._cont_min = self._cont_inv_range = None
+        if hasattr(self.data_interface, 'data_df'):
+            cont_data = self.data_interface.data_df[[self.data_interface.feature_names[ix] for ix in self._cont_idx]]
+            self._cont_min = cont_data.min().to_numpy(dtype=float)
+            cont_range = cont_data.max().to_numpy(dtype=float) - self._cont_min
+            # normalize_data maps constant features to 0
+            self._cont_inv_range = np.divide(1.0, cont_range, out=np.zeros_like(cont_range), where=cont_range != 0)
     # make do_random_init function more efficient
     '''
     def do_random_init(self, num_inits, features_to_vary, query_instance, desired_class, desired_range):
@@ -123,32 +222,101 @@ class DiceGeneticConformance(ExplainerBase):
         return remaining_cfs
     '''
 
-    def do_random_init(self, num_inits, features_to_vary, query_instance, desired_class, desired_range):
-        valid_inits = []
+    def _build_random_init_cache(self, features_to_vary):
+        """Precomputes the per-feature arrays used by do_random_init to sample a whole batch at once."""
+        feature_names = self.data_interface.feature_names
+        continuous_features = set(self.data_interface.continuous_feature_names)
+        features_to_vary = set(features_to_vary)
         precisions = self.data_interface.get_decimal_precisions()
 
-        while len(valid_inits) < num_inits:
-            num_remaining = num_inits - len(valid_inits)
-            num_features = self.data_interface.number_of_features
-
-            # Generate random initializations for all features at once
-            random_inits = np.zeros((num_remaining, num_features))
-            for jx, feature in enumerate(self.data_interface.feature_names):
-                if feature in features_to_vary:
-                    if feature in self.data_interface.continuous_feature_names:
-                        random_inits[:, jx] = np.random.uniform(self.feature_range[feature][0],
-                                                                self.feature_range[feature][1], num_remaining)
-                        random_inits[:, jx] = np.round(random_inits[:, jx], precisions[jx])
-                    else:
-                        random_inits[:, jx] = np.random.choice(self.feature_range[feature], num_remaining)
-                else:
-                    random_inits[:, jx] = query_instance[jx]
-
-            # Filter out the valid initializations
-            valid_mask = np.apply_along_axis(self.is_cf_valid, 1, self.predict_fn_scores(random_inits))
-            valid_inits.extend(random_inits[valid_mask])
-
-        return np.array(valid_inits[:num_inits])
+        vary_mask = np.array([feature in features_to_vary for feature in feature_names], dtype=bool)
+        cont_mask = np.array([feature in continuous_features for feature in feature_names], dtype=bool)
+        cont_idx = np.flatnonzero(vary_mask & cont_mask)
+        cat_idx = np.flatnonzero(vary_mask & ~cont_mask)
+
+        lo = np.array([self.feature_range[feature_names[jx]][0] for jx in cont_idx], dtype=float)
+        hi = np.array([self.feature_range[feature_names[jx]][1] for jx in cont_idx], dtype=float)
+        prec = np.array([precisions[jx] for jx in cont_idx], dtype=float)
+
+        # categorical choices are stacked into a zero-padded table so that one draw covers all columns
+        cat_choices = [np.asarray(self.feature_range[feature_names[jx]], dtype=float) for jx in cat_idx]
+        cat_sizes = np.array([len(choices) for choices in cat_choices], dtype=np.intp)
+        cat_table = np.zeros((len(cat_choices), cat_sizes.max() if len(cat_choices) > 0 else 0))
+        for kx, choices in enumerate(cat_choices):
+            cat_table[kx, :len(choices)] = choices
+
+        self._rand_init_cache = dict(features_to_vary=features_to_vary, vary_mask=vary_mask, cont_idx=cont_idx,
+                                     cat_idx=cat_idx, lo=lo, hi=hi, scale=10.0 ** prec,
+                                     cat_table=cat_table, cat_sizes=cat_sizes)
+
+    def _get_random_init_cache(self, features_to_vary):
+        """Returns the sampling cache, rebuilding it if features_to_vary changed since it was built."""
+        if self._rand_init_cache is None or self._rand_init_cache['features_to_vary'] != set(features_to_vary):
+            self._build_random_init_cache(features_to_vary)
+        return self._rand_init_cache
+
+    def _allocate_population_buffer(self):
+        """Allocates the population buffer, keeping it while the population shape is unchanged."""
+        shape = (self.population_size, self.data_interface.number_of_features)
+        if self._pop_buffer is None or self._pop_buffer.shape != shape:
+            self._pop_buffer = np.empty(shape, dtype=np.float64)
+
+    def _is_cf_valid_batch(self, model_scores):
+        """Vectorized counterpart of is_cf_valid, evaluated on the scores of a whole batch."""
+        model_scores = np.asarray(model_scores)
+        if self.model.model_type == ModelTypes.Classifier:
+            target_cf_class = int(np.ravel(self.target_cf_class)[0])
+            if model_scores.shape[1] in (1, 2):  # binary
+                pred_1 = model_scores[:, -1]
+                if target_cf_class == 0:
+                    return pred_1 <= self.stopping_threshold
+                elif target_cf_class == 1:
+                    return pred_1 >= self.stopping_threshold
+                return np.zeros(len(model_scores), dtype=bool)
+            else:  # multiclass
+                return np.argmax(model_scores, axis=1) == target_cf_class
+        else:
+            model_scores = model_scores.reshape(len(model_scores), -1)[:, 0]
+            return (self.target_cf_range[0] <= model_scores) & (model_scores <= self.target_cf_range[1])
+
+    def do_random_init(self, num_inits, features_to_vary, query_instance, desired_class, desired_range, out=None):
+        """Samples num_inits valid initializations; with out, they are written to out[:num_inits] in place."""
+        cache = self._get_random_init_cache(features_to_vary)
+        cont_idx, cat_idx = cache['cont_idx'], cache['cat_idx']
+        lo, hi, scale = cache['lo'], cache['hi'], cache['scale']
+        cat_table, cat_sizes = cache['cat_table'], cache['cat_sizes']
+        num_cont, num_cat = len(cont_idx), len(cat_idx)
+        query_instance = np.asarray(query_instance, dtype=float).reshape(-1)
+        num_features = self.data_interface.number_of_features
+
+        if out is None:
+            out = np.empty((num_inits, num_features), dtype=np.float64)
+        num_valid = 0
+        while num_valid < num_inits:
+            num_remaining = num_inits - num_valid
+            # oversample by the inverse of the expected acceptance rate so that one model call usually suffices
+            oversampling = min(int(1 / max(self._accept_rate_estimate, 1e-3)), self._max_init_oversampling)
+            batch_size = max(num_remaining * max(1, oversampling), self._min_init_batch_size)
+
+            # Generate random initializations for all features at once; fixed features keep the query value
+            random_inits = np.empty((batch_size, num_features), dtype=np.float64)
+            random_inits[:] = query_instance
+            if num_cont > 0:
+                samples = self._rng.uniform(lo, hi, size=(batch_size, num_cont))
+                random_inits[:, cont_idx] = np.round(samples * scale) / scale
+            if num_cat > 0:
+                picks = (self._rng.random((batch_size, num_cat)) * cat_sizes).astype(np.intp)
+                random_inits[:, cat_idx] = cat_table[np.arange(num_cat), picks]
+
+            # Filter out the valid initializations, keeping at most the number still needed
+            valid_mask = self._is_cf_valid_batch(self._predict_scores_cached(random_inits))
+            num_accepted = int(np.count_nonzero(valid_mask))
+            self._accept_rate_estimate = 0.5 * self._accept_rate_estimate + 0.5 * num_accepted / batch_size
+            new_inits = random_inits[valid_mask][:num_remaining]
+            out[num_valid:num_valid + len(new_inits)] = new_inits
+            num_valid += len(new_inits)
+
+        return out[:num_inits]
 
 
     def do_KD_init(self, features_to_vary, query_instance, cfs, desired_class, desired_range):
@@ -156,43 +324,63 @@ class DiceGeneticConformance(ExplainerBase):
         #cfs = pd.DataFrame(cfs,columns=self.data_interface.feature_names)
         cfs = cfs.reset_index(drop=True)
         query_instance = query_instance.reshape(-1,1)
-        self.cfs = np.zeros((self.population_size, self.data_interface.number_of_features))
-        for kx in range(self.population_size):
-            if kx >= len(cfs):
-                break
-            one_init = np.zeros(self.data_interface.number_of_features)
-            for jx, feature in enumerate(self.data_interface.feature_names):
-                if feature not in features_to_vary:
-                    one_init[jx] = (query_instance[jx])
-                else:
-                    if feature in self.data_interface.continuous_feature_names:
-                        if self.feature_range[feature][0] <= cfs.iat[kx, jx] <= self.feature_range[feature][1]:
-                            one_init[jx] = cfs.iat[kx, jx]
-                        else:
-                            if self.feature_range[feature][0] <= query_instance[jx] <= self.feature_range[feature][1]:
-                                one_init[jx] = query_instance[jx]
-                            else:
-                                one_init[jx] = np.random.uniform(
-                                    self.feature_range[feature][0], self.feature_range[feature][1])
-                    else:
-                        if float(cfs.iat[kx, jx]) in self.feature_range[feature]:
-                            one_init[jx] = cfs.iat[kx, jx]
-                        else:
-                            if float(query_instance[jx]) in self.feature_range[feature]:
-                                one_init[jx] = query_instance[jx]
-                            else:
-                                one_init[jx] = np.random.choice(self.feature_range[feature])
-            self.cfs[kx] = one_init
-            kx += 1
+        num_features = self.data_interface.number_of_features
+        # the initial population gets its own array: the buffer is overwritten by the first generation
+        self.cfs = np.zeros((self.population_size, num_features))
+        num_cfs = min(self.population_size, len(cfs))
+        cache = self._get_random_init_cache(features_to_vary)
+        cont_idx, cat_idx = cache['cont_idx'], cache['cat_idx']
+        cat_table, cat_sizes = cache['cat_table'], cache['cat_sizes']
+
+        # the KD tree output keeps the feature columns first, in the same order as feature_names
+        cfs_np = cfs.iloc[:num_cfs, :num_features].to_numpy(dtype=float)
+        query_np = query_instance.reshape(-1).astype(float)
+        one_inits = np.empty((num_cfs, num_features), dtype=np.float64)
+        one_inits[:] = query_np
+
+        # continuous features: keep the neighbour's value if in range, else the query's, else a random value
+        if len(cont_idx) > 0:
+            lo, hi = cache['lo'], cache['hi']
+            neighbour_values = cfs_np[:, cont_idx]
+            query_values = query_np[cont_idx]
+            query_in_range = (lo <= query_values) & (query_values <= hi)
+            fallback = np.where(query_in_range, query_values,
+                                self._rng.uniform(lo, hi, size=(num_cfs, len(cont_idx))))
+            one_inits[:, cont_idx] = np.where((lo <= neighbour_values) & (neighbour_values <= hi),
+                                              neighbour_values, fallback)
+
+        # categorical features: same cascade, with membership in the valid levels as the range check
+        for kx, jx in enumerate(cat_idx):
+            choices = cat_table[kx, :cat_sizes[kx]]
+            if query_np[jx] in choices:
+                fallback = query_np[jx]
+            else:
+                fallback = self._rng.choice(choices, num_cfs)
+            one_inits[:, jx] = np.where(np.isin(cfs_np[:, jx], choices), cfs_np[:, jx], fallback)
 
-        new_array = [tuple(row) for row in self.cfs]
-        uniques = np.unique(new_array, axis=0)
+        self.cfs[:num_cfs] = one_inits
 
-        if len(uniques) != self.population_size:
-            remaining_cfs = self.do_random_init(
-                self.population_size - len(uniques), features_to_vary, query_instance, desired_class, desired_range)
-            self.cfs = np.concatenate([uniques, remaining_cfs])
+        uniques = np.unique(self.cfs, axis=0)
 
+        if len(uniques) != self.population_size:
+            # the unique rows go first and the random initializations fill the rest of the population
+            self.cfs[:len(uniques)] = uniques
+            self.do_random_init(self.population_size - len(uniques), features_to_vary, query_instance,
+                                desired_class, desired_range, out=self.cfs[len(uniques):])
+
+
+    def _get_KD_tree(self, desired_range, desired_class):
+        """Returns the output of build_KD_tree, built once per target while the training data is unchanged."""
+        data_df = self.data_interface.data_df
+        data_key = (id(data_df), len(data_df))
+        if self._kd_cache_data_key != data_key:
+            self._kd_cache.clear()
+            self._kd_cache_data_key = data_key
+        key = (desired_class, tuple(desired_range) if desired_range is not None else None)
+        if key not in self._kd_cache:
+            self._kd_cache[key] = self.build_KD_tree(data_df.copy(), desired_range, desired_class,
+                                                     self.predicted_outcome_name)
+        return self._kd_cache[key]
 
     def do_cf_initializations(self, total_CFs, initialization, algorithm, features_to_vary, desired_range,
                               desired_class,
@@ -220,8 +408,7 @@ class DiceGeneticConformance(ExplainerBase):
         elif initialization == 'kdtree':
             # Partitioned dataset and KD Tree for each class (binary) of the dataset
             self.dataset_with_predictions, self.KD_tree, self.predictions = \
-                self.build_KD_tree(self.data_interface.data_df.copy(),
-                                   desired_range, desired_class, self.predicted_outcome_name)
+                self._get_KD_tree(desired_range, desired_class)
             if self.KD_tree is None:
                 self.cfs = self.do_random_init(
                     self.population_size, features_to_vary, query_instance, desired_class, desired_range)
@@ -243,6 +430,12 @@ class DiceGeneticConformance(ExplainerBase):
             print("Initializing initial parameters to the genetic algorithm...")
 
         self.feature_range = self.get_valid_feature_range(normalized=False)
+        # conformance results are only reused within a query, so that the memo does not grow across queries
+        self._conf_cache.clear()
+        self._conf_cache_owner = None
+        self._build_random_init_cache(features_to_vary)
+        self._allocate_population_buffer()
+        _dist_numba.warm_up()
         if len(self.cfs) != total_CFs:
             self.do_cf_initializations(
                 total_CFs, initialization, algorithm, features_to_vary, desired_range, desired_class,
@@ -259,7 +452,8 @@ class DiceGeneticConformance(ExplainerBase):
                                   yloss_type="hinge_loss", diversity_loss_type="dpp_style:inverse_dist",
                                   feature_weights="inverse_mad", stopping_threshold=0.25, posthoc_sparsity_param=0,
                                   posthoc_sparsity_algorithm="linear", maxiterations=50, thresh=1e-2, verbose=True,conformance_weight=3,
-                                  model_path=None,optimization=None,heuristic=None, random_seed=None, adapted=None, activity_origin_position = None, activity_origin_name = None, conformance_penalty = None):
+                                  model_path=None,optimization=None,heuristic=None, random_seed=None, adapted=None, activity_origin_position = None, activity_origin_name = None, conformance_penalty = 0.0,
+                                  n_jobs=1):
         """Generates diverse counterfactual explanations
 
         :param query_instance: A dictionary of feature names and values. Test point of interest.
@@ -298,6 +492,10 @@ class DiceGeneticConformance(ExplainerBase):
         :param verbose: Parameter to determine whether to print 'Diverse Counterfactuals found!'
         :param activity_origin_position: the position of the activity in the original log (to be compare with the position in the syntetic log)
         :param activity_origin_name: the name of the activity in the original log (to be compare with the position in the syntetic log)
+        :param conformance_penalty: A number subtracted from the conformance score of the counterfactuals that lack
+                                    activity_origin_name or keep it at activity_origin_position. 0.0 applies no penalty.
+        :param n_jobs: Number of worker processes used to evaluate the population (model scores and conformance)
+                       in each generation. 1 evaluates sequentially, -1 uses all cores.
 
         :return: A CounterfactualExamples object to store and visualize the resulting counterfactual explanations
                  (see diverse_counterfactuals.py).
@@ -307,36 +505,38 @@ class DiceGeneticConformance(ExplainerBase):
         logger.debug(f"Activity original position received in _generate_counterfactuals: {activity_origin_position}")
         logger.debug(f"Activity original name received in _generate_counterfactuals: {activity_origin_name}")
         logger.debug(f"Conformance penalty received in _generate_counterfactuals: {conformance_penalty}")
-        
+
         random.seed(random_seed)
         np.random.seed(random_seed)
+        self._rng = np.random.default_rng(random_seed)
+        # every generation is scored with the penalty, so a missing one fails before the search starts
+        if not isinstance(conformance_penalty, numbers.Real):
+            raise UserConfigValidationException(
+                "conformance_penalty should be a number, got {}".format(conformance_penalty))
         if not hasattr(self.data_interface, 'data_df') and initialization == "kdtree":
             raise UserConfigValidationException(
                     "kd-tree initialization is not supported for private data"
                     " interface because training data to build kd-tree is not available.")
 
         self.population_size = 15 * total_CFs
+        self.n_jobs = n_jobs
 
         self.start_time = timeit.default_timer()
 
         features_to_vary = self.setup(features_to_vary, permitted_range, query_instance, feature_weights)
 
         # Prepares user defined query_instance for DiCE.
-        query_instance_orig = query_instance
-        query_instance_orig = self.data_interface.prepare_query_instance(
-                query_instance=query_instance_orig)
-        query_instance = self.data_interface.prepare_query_instance(
+        query_instance_prepared = self.data_interface.prepare_query_instance(
                 query_instance=query_instance)
         # number of output nodes of ML model
         self.num_output_nodes = None
         if self.model.model_type == ModelTypes.Classifier:
-            self.num_output_nodes = self.model.get_num_output_nodes2(query_instance)
+            self.num_output_nodes = self.model.get_num_output_nodes2(query_instance_prepared)
 
         #query_instance = self.label_encode(query_instance)
         #query_instance = pd.DataFrame(query_instance,columns=self.data_interface.feature_names)
-        query_instance = np.array(query_instance.values[0])
-        self.x1 = query_instance
-        query_instance = query_instance.reshape(1,-1)
+        self.x1 = query_instance_prepared.to_numpy()[0]
+        query_instance = self.x1.reshape(1,-1)
         # find the predicted value of query_instance
         test_pred = self.predict_fn(query_instance)
 
@@ -344,24 +544,31 @@ class DiceGeneticConformance(ExplainerBase):
 
         desired_class = self.misc_init(stopping_threshold, desired_class, desired_range, test_pred)
 
-        query_instance_df_dummies = pd.get_dummies(query_instance_orig)
-        for col in self.data_interface.get_all_dummy_colnames():
-            if col not in query_instance_df_dummies.columns:
-                query_instance_df_dummies[col] = 0
+        query_instance_df_dummies = self._encode_dummies(query_instance_prepared)
 
         self.do_param_initializations(total_CFs, initialization, desired_range, desired_class, query_instance,
                                       query_instance_df_dummies, algorithm, features_to_vary, permitted_range,
                                       yloss_type, diversity_loss_type, feature_weights, proximity_weight,
                                       sparsity_weight,plausibility_weight, diversity_weight, categorical_penalty,conformance_weight,encoder, verbose)
-        d4py = Declare4Py()
-        d4py.parse_decl_model(os.path.join(model_path,(dataset+'.decl')))
-        self.filter_declare_model(query_instance,encoder,d4py)
-
-        activities, activations, targets = self.get_constraint_activities(d4py)
-
-        query_instance_df = self.find_counterfactuals(query_instance, desired_range, desired_class, features_to_vary,
-                                                      maxiterations, thresh, verbose,encoder,dataset,model_path,d4py,optimization,
-                                                      heuristic,activities,activations,targets,adapted, activity_origin_position, activity_origin_name, conformance_penalty)
+        # the pruned model only depends on the .decl file, the query and the encoder
+        decl_path = os.path.join(model_path,(dataset+'.decl'))
+        pruned_model_key = (decl_path, os.path.getmtime(decl_path), np.asarray(query_instance, dtype=float).tobytes(),
+                            encoder)
+        if pruned_model_key != self._pruned_model_key:
+            d4py = self._load_declare_model(decl_path)
+            self.filter_declare_model(query_instance,encoder,d4py)
+            self._pruned_model = (d4py, self.get_constraint_activities(d4py))
+            self._pruned_model_key = pruned_model_key
+        d4py, (activities, activations, targets) = self._pruned_model
+
+        self._start_conformance_pool(encoder, d4py, activity_origin_position, activity_origin_name,
+                                     conformance_penalty)
+        try:
+            query_instance_df = self.find_counterfactuals(query_instance, desired_range, desired_class, features_to_vary,
+                                                          maxiterations, thresh, verbose,encoder,dataset,model_path,d4py,optimization,
+                                                          heuristic,activities,activations,targets,adapted, activity_origin_position, activity_origin_name, conformance_penalty)
+        finally:
+            self._stop_conformance_pool()
         ## change model given to this function
         return exp.CounterfactualExamples(data_interface=self.data_interface,
                                           test_instance_df=query_instance_df,
@@ -372,20 +579,196 @@ class DiceGeneticConformance(ExplainerBase):
                                           desired_class=desired_class,
                                           model_type=self.model.model_type)
 
-    def predict_fn_scores(self, input_instance):
-        """Returns prediction scores."""
-        #input_instance = self.label_decode(input_instance)
-        input_instance = pd.DataFrame(input_instance,columns=self.data_interface.feature_names)
-        out = self.model.get_output(input_instance)
-        if self.model.model_type == ModelTypes.Classifier and out.shape[1] == 1:
+    def _encode_dummies(self, query_instance_df):
+        """One-hot encodes the prepared query with the columns (and column order) of the training data."""
+        return pd.get_dummies(query_instance_df, dtype=np.uint8).reindex(
+            columns=self._all_dummy_colnames, fill_value=0)
+
+    def _load_declare_model(self, path):
+        """Returns a fresh copy of the declare model at path, parsing the file only when it changed.
+
+        filter_declare_model prunes the model in place, so every query gets its own copy.
+        """
+        from declare4py.declare4py import Declare4Py
+
+        key = (path, os.path.getmtime(path))
+        if key not in self._d4py_cache:
+            d4py = Declare4Py()
+            d4py.parse_decl_model(path)
+            self._d4py_cache[key] = d4py
+        return copy.deepcopy(self._d4py_cache[key])
+
+    def _predict_scores_from_array(self, input_instance):
+        """Wraps a label-encoded array once and returns the model scores."""
+        input_instance = pd.DataFrame(input_instance, columns=self._feature_index, copy=False)
+        out = self.model.get_output(input_instance, model_score=True)
+        if self.model.model_type == ModelTypes.Classifier and np.array(out).shape[1] == 1:
             # DL models return only 1 for binary classification
             out = np.hstack((1-out, out))
         return out
 
+    def _predict_scores_cached(self, input_instance):
+        """Returns model scores for a batch, calling the model only on the distinct rows not scored recently.
+
+        Individuals carried over by selection are identical byte-for-byte across generations, so their
+        scores are served from a small LRU cache, see _scores_cache_capacity().
+        """
+        input_instance = np.ascontiguousarray(input_instance)
+        unique_rows, inverse = np.unique(input_instance, axis=0, return_inverse=True)
+        keys = [row.tobytes() for row in unique_rows]
+        cache = self._scores_cache
+        misses = [ix for ix, key in enumerate(keys) if key not in cache]
+        if len(misses) > 0:
+            miss_scores = self._predict_scores_from_array(unique_rows[misses])
+            for ix, scores in zip(misses, miss_scores):
+                cache[keys[ix]] = scores
+        unique_scores = np.array([cache[key] for key in keys])
+        for key in keys:
+            cache.move_to_end(key)
+        self._trim_scores_cache()
+        return unique_scores[inverse.reshape(-1)]
+
+    def _scores_cache_capacity(self):
+        """Returns the size of the largest batch scored at once, a random initialization batch or a generation.
+
+        A smaller bound would let a single do_random_init() batch flush the rows kept for the next generation.
+        """
+        return max(self.population_size * self._max_init_oversampling, self._min_init_batch_size)
+
+    def _trim_scores_cache(self):
+        capacity = self._scores_cache_capacity()
+        while len(self._scores_cache) > capacity:
+            self._scores_cache.popitem(last=False)
+
+    def _evaluate_population(self, population, encoder, d4py, activity_origin_position, activity_origin_name,
+                             conformance_penalty):
+        """Evaluates the model scores and the conformance of every individual of a generation.
+
+        Only the individuals whose conformance is not memoized yet are evaluated, see _memoized_conformance().
+        """
+        return self._memoized_conformance(population, encoder, d4py, activity_origin_position, activity_origin_name,
+                                          conformance_penalty, self._evaluate_rows)
+
+    def _evaluate_rows(self, population, encoder, d4py, activity_origin_position, activity_origin_name,
+                       conformance_penalty):
+        """Computes the conformance of population, in parallel when n_jobs != 1.
+
+        With n_jobs != 1 the population is split into one chunk per worker (the chunk sizes differ by at most
+        one row, the population size does not depend on n_jobs); the scores are stored in the
+        score cache so that compute_loss does not query the model again. The chunks go to the worker pool of
+        _start_conformance_pool() when there is one, otherwise to joblib workers that receive a pickled copy
+        of the explainer with every chunk.
+        """
+        num_workers = effective_n_jobs(self.n_jobs)
+        if num_workers == 1 or len(population) < 2 * num_workers:
+            return self._compute_conformance_rows(population, encoder, d4py, activity_origin_position,
+                                                  activity_origin_name, conformance_penalty)
+
+        population = np.ascontiguousarray(population)
+        chunks = np.array_split(population, num_workers)
+        if self._pool is not None:
+            results = self._pool(delayed(_evaluate_pooled_chunk)(chunk) for chunk in chunks)
+        else:
+            results = Parallel(n_jobs=num_workers, backend='loky')(
+                delayed(_evaluate_chunk)(self, chunk, encoder, d4py, activity_origin_position, activity_origin_name,
+                                         conformance_penalty)
+                for chunk in chunks)
+
+        conformance_score = []
+        model_check_res = {}
+        offset = 0
+        for chunk, (scores, chunk_conformance, chunk_check_res) in zip(chunks, results):
+            for row, row_scores in zip(chunk, scores):
+                self._scores_cache[row.tobytes()] = row_scores
+            conformance_score.append(chunk_conformance)
+            # case ids restart from 1 in every chunk
+            for case_key, res in chunk_check_res.items():
+                model_check_res[_shift_case_key(case_key, offset)] = res
+            offset += len(chunk)
+        self._trim_scores_cache()
+        return np.concatenate(conformance_score), model_check_res
+
+    def _start_conformance_pool(self, encoder, d4py, activity_origin_position, activity_origin_name,
+                                conformance_penalty):
+        """Starts the worker processes used by _evaluate_rows() for the current query, if n_jobs != 1.
+
+        The workers receive the explainer, the encoder and the pruned declare model once, through the worker
+        initializer, instead of unpickling them for every chunk. The workers are joblib's (loky) processes,
+        which are started fresh and reused across generations: forking the parent after the numba parallel
+        kernels have run can deadlock the workers.
+        """
+        self._pool = None
+        num_workers = effective_n_jobs(self.n_jobs)
+        if num_workers == 1:
+            return
+        self._pool = Parallel(
+            n_jobs=num_workers, backend='loky', initializer=_init_conformance_worker,
+            initargs=(self, encoder, d4py, activity_origin_position, activity_origin_name, conformance_penalty))
+
+    def _stop_conformance_pool(self):
+        """Releases the workers of _start_conformance_pool(); joblib shuts them down once they are idle."""
+        self._pool = None
+
+    def _memoized_conformance(self, population, encoder, d4py, activity_origin_position, activity_origin_name,
+                              conformance_penalty, evaluate):
+        """Returns the conformance of population, calling evaluate only on the rows never scored before.
+
+        The GA carries many identical individuals over from one generation to the next; their scores and
+        conformance results are kept in _conf_cache, keyed by the bytes of the row. The cache is cleared
+        for every query (see do_param_initializations()) and whenever the declare model, the encoder or the
+        penalty settings change.
+        """
+        settings = (activity_origin_position, activity_origin_name, conformance_penalty)
+        owner = self._conf_cache_owner
+        if owner is None or owner[0] is not d4py or owner[1] is not encoder or owner[2] != settings:
+            self._conf_cache.clear()
+            self._conf_cache_owner = (d4py, encoder, settings)
+
+        population = np.ascontiguousarray(population)
+        keys = [row.tobytes() for row in population]
+        cache = self._conf_cache
+        misses = {}
+        for ix, key in enumerate(keys):
+            if key not in cache and key not in misses:
+                misses[key] = ix
+        if len(misses) > 0:
+            miss_idx = list(misses.values())
+            scores, check_res = evaluate(population[miss_idx], encoder, d4py, activity_origin_position,
+                                         activity_origin_name, conformance_penalty)
+            # remember where each case sat in the evaluated batch, so that its key can be moved later on
+            for pos, (ix, (case_key, res)) in enumerate(zip(miss_idx, check_res.items())):
+                cache[keys[ix]] = (scores[pos], case_key, pos, res)
+
+        conformance_score = np.array([cache[key][0] for key in keys], dtype=np.float32)
+        model_check_res = {}
+        for ix, key in enumerate(keys):
+            _, case_key, pos, res = cache[key]
+            model_check_res[_shift_case_key(case_key, ix - pos)] = res
+        return conformance_score, model_check_res
+
+    def __getstate__(self):
+        """Leaves the per-query caches out of the copies sent to the worker processes."""
+        state = self.__dict__.copy()
+        state['_scores_cache'] = OrderedDict()
+        state['_pool'] = None
+        state['_conf_cache'] = {}
+        state['_conf_cache_owner'] = None
+        state['_plaus_cache'] = {}
+        state['_plaus_cache_owner'] = None
+        state['_d4py_cache'] = {}
+        state['_pruned_model_key'] = None
+        state['_pruned_model'] = None
+        state['_kd_cache'] = {}
+        state['_kd_cache_data_key'] = None
+        return state
+
+    def predict_fn_scores(self, input_instance):
+        """Returns prediction scores."""
+        return self._predict_scores_from_array(input_instance)
+
     def predict_fn(self, input_instance):
         """Returns actual prediction."""
-        #input_instance = self.label_decode(input_instance)
-        input_instance = pd.DataFrame(input_instance,columns=self.data_interface.feature_names)
+        input_instance = pd.DataFrame(input_instance, columns=self._feature_index, copy=False)
         preds = self.model.get_output(input_instance, model_score=False)
         return preds
 
@@ -397,22 +780,20 @@ class DiceGeneticConformance(ExplainerBase):
         of 2. This is why we need a custom predict function that returns the desired class if the maximum predict
         probability is the same as the probability of the desired class."""
 
-        #input_instance = self.label_decode(input_instance)
-        input_instance = pd.DataFrame(input_instance,columns=self.data_interface.feature_names)
-        output = self.model.get_output(input_instance, model_score=True)
-        if self.model.model_type == ModelTypes.Classifier and np.array(output).shape[1] == 1:
-            # DL models return only 1 for binary classification
-            output = np.hstack((1-output, output))
+        output = self._predict_scores_from_array(input_instance)
         desired_class = int(desired_class)
         maxvalues = np.max(output, 1)
         predicted_values = np.argmax(output, 1)
 
-        # We iterate through output as we often call _predict_fn_custom for multiple inputs at once
-        for i in range(len(output)):
-            if output[i][desired_class] == maxvalues[i]:
-                predicted_values[i] = desired_class
+        # ties with the maximum score are resolved in favour of desired_class, for all inputs at once
+        return np.where(output[:, desired_class] == maxvalues, desired_class, predicted_values)
 
-        return predicted_values
+    def _get_training_array(self):
+        """Returns the training data as a float array, converted once per training set."""
+        X_y = self.data_interface.data_df
+        if self._X_y_np is None or self._X_y_np[0] is not X_y:
+            self._X_y_np = (X_y, X_y.to_numpy(dtype=float))
+        return self._X_y_np[1]
 
     def compute_plausibility(self, cfs=None, ratio_cont=None):
         query_instance = self.x1
@@ -421,50 +802,106 @@ class DiceGeneticConformance(ExplainerBase):
         dists = []
         ratio_cont = len(continuous_features) / len(categorical_features)
         X_y = self.data_interface.data_df
-        neigh_dist = self.distance_mh(query_instance=query_instance.reshape(1, -1), cf_list=X_y.to_numpy(), X=X_y)
-        idx_neigh = np.argsort(neigh_dist)[0][0]
-        closest = X_y.to_numpy()[idx_neigh]
+        X_y_np = self._get_training_array()
+        neigh_dist = self.distance_mh(query_instance=query_instance.reshape(1, -1), cf_list=X_y_np, X=X_y)
+        idx_neigh = int(np.argmin(neigh_dist.ravel()))
+        closest = X_y_np[idx_neigh]
         if cfs is None:
             cfs = self.cfs
         dists = self.distance_mh(query_instance=closest.reshape(1, -1), cf_list=cfs, X=X_y)
         return np.array(dists)
 
+    def _memoized_plausibility(self, cfs):
+        """Returns compute_plausibility(cfs) as a flat array, computing it only for the rows never seen before.
+
+        The plausibility of a row only depends on the row, the query and the training data, so the values are
+        kept in _plaus_cache until one of the latter two changes.
+        """
+        query_key = np.asarray(self.x1, dtype=float).tobytes()
+        owner = self._plaus_cache_owner
+        if owner is None or owner[0] != query_key or owner[1] is not self.data_interface.data_df:
+            self._plaus_cache.clear()
+            self._plaus_cache_owner = (query_key, self.data_interface.data_df)
+
+        cfs = np.ascontiguousarray(cfs)
+        keys = [row.tobytes() for row in cfs]
+        cache = self._plaus_cache
+        misses = {}
+        for ix, key in enumerate(keys):
+            if key not in cache and key not in misses:
+                misses[key] = ix
+        if len(misses) > 0:
+            miss_idx = list(misses.values())
+            dists = np.ravel(self.compute_plausibility(cfs=cfs[miss_idx]))
+            for key, dist in zip(misses, dists):
+                cache[key] = dist
+        return np.array([cache[key] for key in keys])
+
     # update here to not get confused
     def distance_mh(self, query_instance, cf_list, X, ratio_cont=None, agg=None):
         nbr_features = self.data_interface.number_of_features
         cont_feature_index = self.data_interface.continuous_feature_indexes
         cat_feature_index = self.data_interface.categorical_feature_indexes
-        dist_cont = self.continuous_distance(query_instance=query_instance, cf_list=cf_list, metric='cityblock', X=X, agg=agg)
-        dist_cont =  dist_cont / len(query_instance[0])
-        try:
-            dist_cate = self.categorical_distance(query_instance=query_instance.astype('float64'), cf_list=cf_list,
-                                                  metric='hamming', agg=agg)
-        except:
-            dist_cate = self.categorical_distance(query_instance=query_instance.astype('float64'),
-                                                  cf_list=cf_list.astype('float64'), metric='hamming', agg=agg)
+        query_instance = np.asarray(query_instance, dtype=float)
+        cf_list = np.asarray(cf_list, dtype=float)
         if ratio_cont is None:
             ratio_continuous = len(cont_feature_index) / nbr_features
             ratio_categorical = len(cat_feature_index) / nbr_features
         else:
             ratio_continuous = ratio_cont
             ratio_categorical = 1.0 - ratio_cont
+
+        if _dist_numba.NUMBA_AVAILABLE and query_instance.shape[0] == 1 and agg is None:
+            # single fused pass over cf_list instead of the per-feature-kind NumPy temporaries below
+            cont_feature_index = np.asarray(cont_feature_index, dtype=np.intp)
+            dist = _dist_numba.mixed_distance(
+                np.ascontiguousarray(cf_list), np.ascontiguousarray(query_instance[0]), cont_feature_index,
+                np.asarray(cat_feature_index, dtype=np.intp), np.ones(len(cont_feature_index)),
+                float(len(query_instance[0])), float(ratio_continuous), float(ratio_categorical))
+            return dist[np.newaxis, :]
+
+        # a feature kind without columns contributes nothing, so its distance is not computed at all
+        has_cont = len(cont_feature_index) > 0
+        has_cat = len(cat_feature_index) > 0
+        if has_cont:
+            dist_cont = self.continuous_distance(query_instance=query_instance, cf_list=cf_list, metric='cityblock',
+                                                 X=X, agg=agg)
+            dist_cont = dist_cont / len(query_instance[0])
+            if not has_cat:
+                return dist_cont
+        dist_cate = self.categorical_distance(query_instance=query_instance, cf_list=cf_list, metric='hamming', agg=agg)
+        if not has_cont:
+            return dist_cate
         dist = ratio_continuous * dist_cont + ratio_categorical * dist_cate
         return dist
 
-    def continuous_distance(self, query_instance, cf_list, metric='cityblock', X=None, agg=None):
-        cont_feature_index = self.data_interface.continuous_feature_indexes
-        if metric == 'mad':
+    def _get_continuous_mads(self, X):
+        """Returns the MADs of the continuous features of X, computed once per training set."""
+        if self._cont_mads is None or self._cont_mads[0] is not X:
+            cont_feature_index = self.data_interface.continuous_feature_indexes
             mad = median_abs_deviation(X.iloc[:, cont_feature_index], axis=0)
-            mad = np.array([v if v != 0 else 1.0 for v in mad])
+            mad = np.where(mad != 0, mad, 1.0)
+            self._cont_mads = (X, mad, np.reciprocal(mad))
+        return self._cont_mads[1]
 
-            def _mad_cityblock(u, v):
-                return mad_cityblock(u, v, mad)
+    def _get_continuous_inv_mads(self, X):
+        """Returns 1 / MAD of the continuous features of X, see _get_continuous_mads()."""
+        self._get_continuous_mads(X)
+        return self._cont_mads[2]
 
-            dist = cdist(query_instance.reshape(1, -1)[:, cont_feature_index], cf_list[:, cont_feature_index],
-                         metric=_mad_cityblock)
+    def continuous_distance(self, query_instance, cf_list, metric='cityblock', X=None, agg=None):
+        cont_feature_index = self.data_interface.continuous_feature_indexes
+        # the query is a single row, so the pairwise distance reduces to a row-wise sum against it
+        # (returned with cdist's (1, len(cf_list)) shape)
+        query_cont = query_instance.reshape(1, -1)[:, cont_feature_index]
+        if metric == 'mad':
+            dist = mad_cityblock_batch(cf_list[:, cont_feature_index], query_cont[0],
+                                       self._get_continuous_inv_mads(X))[np.newaxis, :]
+        elif metric == 'cityblock':
+            l1_diff = np.abs(cf_list[:, cont_feature_index] - query_cont)
+            dist = l1_diff.sum(axis=1)[np.newaxis, :]
         else:
-            dist = cdist(query_instance.reshape(1, -1)[:, cont_feature_index].astype('float'), cf_list[:, cont_feature_index].astype('float'),
-                         metric=metric)
+            dist = cdist(query_cont, cf_list[:, cont_feature_index], metric=metric)
 
         if agg == 'mean':
             return np.mean(dist)
@@ -479,7 +916,14 @@ class DiceGeneticConformance(ExplainerBase):
 
     def categorical_distance(self, query_instance, cf_list, metric='jaccard', agg=None):
         cat_feature_index = self.data_interface.categorical_feature_indexes
-        dist = cdist(query_instance.reshape(1, -1)[:, cat_feature_index], cf_list[:, cat_feature_index], metric=metric)
+        if metric == 'hamming':
+            # fraction of categorical features that differ from the (single-row) query
+            query_cat = query_instance.reshape(1, -1)[:, cat_feature_index]
+            mismatches = cf_list[:, cat_feature_index] != query_cat
+            dist = mismatches.mean(axis=1)[np.newaxis, :]
+        else:
+            dist = cdist(query_instance.reshape(1, -1)[:, cat_feature_index], cf_list[:, cat_feature_index],
+                         metric=metric)
 
         if agg == 'mean':
             return np.mean(dist)
@@ -497,117 +941,113 @@ class DiceGeneticConformance(ExplainerBase):
         """Computes the first part (y-loss) of the loss function."""
         yloss = 0.0
         if self.model.model_type == ModelTypes.Classifier:
-            predicted_value = np.array(self.predict_fn_scores(cfs))
+            predicted_value = np.array(self._predict_scores_cached(cfs))
             if self.yloss_type == 'hinge_loss':
-                maxvalue = np.full((len(predicted_value)), -np.inf)
-                for c in range(self.num_output_nodes):
-                    if c != desired_class:
-                        maxvalue = np.maximum(maxvalue, predicted_value[:, c])
-                yloss = np.maximum(0, maxvalue - predicted_value[:, int(desired_class)])
+                desired_class = int(desired_class)
+                if _dist_numba.NUMBA_AVAILABLE:
+                    return _dist_numba.hinge_loss(np.ascontiguousarray(predicted_value, dtype=np.float64),
+                                                  desired_class, self.num_output_nodes)
+                # highest score among the other classes, computed in a single masked pass
+                other_classes = np.arange(predicted_value.shape[1]) < self.num_output_nodes
+                other_classes[desired_class] = False
+                maxvalue = np.max(predicted_value, axis=1, where=other_classes, initial=-np.inf)
+                yloss = np.maximum(0, maxvalue - predicted_value[:, desired_class])
             return yloss
 
         elif self.model.model_type == ModelTypes.Regressor:
-            predicted_value = self.predict_fn(cfs)
+            predicted_value = np.ravel(self.predict_fn(cfs))
             if self.yloss_type == 'hinge_loss':
-                yloss = np.zeros(len(predicted_value))
-                for i in range(len(predicted_value)):
-                    if not desired_range[0] <= predicted_value[i] <= desired_range[1]:
-                        yloss[i] = min(abs(predicted_value[i] - desired_range[0]),
-                                       abs(predicted_value[i] - desired_range[1]))
+                out_of_range = (predicted_value < desired_range[0]) | (predicted_value > desired_range[1])
+                distance = np.minimum(np.abs(predicted_value - desired_range[0]),
+                                      np.abs(predicted_value - desired_range[1]))
+                yloss = np.where(out_of_range, distance, 0.0)
             return yloss
 
     def compute_proximity_loss(self, x_hat_unnormalized, query_instance_normalized):
         """Compute weighted distance between two vectors."""
         x_hat = self.data_interface.normalize_data(x_hat_unnormalized)
-        feature_weights = np.array(
-            [self.feature_weights_list[0][i] for i in self.data_interface.continuous_feature_indexes])
-        product = np.multiply(
-            (abs(x_hat - query_instance_normalized)[:, [self.data_interface.continuous_feature_indexes]]),
-            feature_weights)
-        product = product.reshape(-1, product.shape[-1])
-        proximity_loss = np.sum(product, axis=1)
-
-        # Dividing by the sum of feature weights to normalize proximity loss
-        return proximity_loss / sum(feature_weights)
+        cont_idx = self._cont_idx
+        # the weights are already divided by their sum, which normalizes the proximity loss
+        return np.einsum('ij,j->i', np.abs(x_hat[:, cont_idx] - query_instance_normalized[..., cont_idx]),
+                         self._fw_norm)
 
     def compute_sparsity_loss(self, cfs):
         """Compute weighted distance between two vectors."""
-        sparsity_loss = np.count_nonzero(np.asarray(cfs,dtype='int') - np.asarray(self.x1,dtype='int'), axis=1)
-        return sparsity_loss / len(
-            self.data_interface.feature_names)  # Dividing by the number of features to normalize sparsity loss
-    def compute_filtered_loss(self,query_instance,cfs, desired_range, desired_class):
+        sparsity_loss = np.count_nonzero(np.asarray(cfs).astype(np.int64, copy=False) != self._x1_int, axis=1)
+        return sparsity_loss * self._inv_nfeat  # Dividing by the number of features to normalize sparsity loss
+    def _compute_loss(self, cfs, desired_range, desired_class, include_conformance, conformance_score=None):
+        """Computes the overall loss of every cf as rows of (index, loss), accumulated in place.
+
+        With include_conformance, conformance_score defaults to the scores last stored in self.conformance_score.
+        """
+        ##TODO Fix proximity loss
         self.yloss = self.compute_yloss(cfs, desired_range, desired_class)
-        self.proximity_loss = self.compute_proximity_loss(cfs, self.query_instance_normalized) \
-            if self.proximity_weight > 0 and len(self.data_interface.continuous_feature_indexes) > 1 else 0.0
-        self.sparsity_loss = self.compute_sparsity_loss(cfs) if self.sparsity_weight > 0 else 0.0
-        self.plausibility_loss = self.compute_plausibility(cfs = cfs)
-        # TODO DO ONLY ONE ROUND OF COMPUTE PERFORMANCE AND SAVE THE SCORE
-        self.loss = np.reshape(np.array(self.yloss
-                                            + (self.proximity_weight * self.proximity_loss) + (self.sparsity_weight * self.sparsity_loss)
-                                           # + (self.conformance_weight * (1 - self.conformance_score))
-                            + (self.plausibility_weight * self.plausibility_loss)), (-1, 1))
-        index = np.reshape(np.arange(len(cfs)), (-1, 1))
-        self.loss = np.concatenate([index, self.loss], axis=1)
+        use_proximity = self.proximity_weight > 0 and len(self.data_interface.continuous_feature_indexes) > 1
+        use_sparsity = self.sparsity_weight > 0
+        if _dist_numba.NUMBA_AVAILABLE and self._cont_min is not None and (use_proximity or use_sparsity):
+            # both losses in one pass over the population, without the normalized copy of cfs
+            proximity_loss, sparsity_loss = _dist_numba.proximity_sparsity(
+                np.ascontiguousarray(cfs), np.ravel(self.query_instance_normalized)[self._cont_idx], self._x1_int,
+                self._cont_idx, self._cont_min, self._cont_inv_range, self._fw_norm)
+            self.proximity_loss = proximity_loss if use_proximity else 0.0
+            self.sparsity_loss = sparsity_loss if use_sparsity else 0.0
+        else:
+            self.proximity_loss = self.compute_proximity_loss(cfs, self.query_instance_normalized) \
+                if use_proximity else 0.0
+            self.sparsity_loss = self.compute_sparsity_loss(cfs) if use_sparsity else 0.0
+        self.plausibility_loss = self._memoized_plausibility(cfs) if self.plausibility_weight > 0 else 0.0
+
+        self.loss = np.empty((len(cfs), 2))
+        self.loss[:, 0] = np.arange(len(cfs))
+        loss = self.loss[:, 1]
+        loss[:] = self.yloss
+        loss += self.proximity_weight * self.proximity_loss
+        loss += self.sparsity_weight * self.sparsity_loss
+        if include_conformance:
+            if conformance_score is None:
+                conformance_score = self.conformance_score
+            loss += self.conformance_weight * (1 - conformance_score)
+        loss += self.plausibility_weight * self.plausibility_loss
         return self.loss
+
+    def compute_filtered_loss(self,query_instance,cfs, desired_range, desired_class):
+        return self._compute_loss(cfs, desired_range, desired_class, include_conformance=False)
+
     def compute_baseline_loss(self,query_instance,cfs, desired_range, desired_class):
-        self.yloss = self.compute_yloss(cfs, desired_range, desired_class)
-        self.proximity_loss = self.compute_proximity_loss(cfs, self.query_instance_normalized) \
-            if self.proximity_weight > 0 and len(self.data_interface.continuous_feature_indexes) > 1 else 0.0
-        self.sparsity_loss = self.compute_sparsity_loss(cfs) if self.sparsity_weight > 0 else 0.0
-        self.plausibility_loss = self.compute_plausibility(cfs = cfs)
-        # TODO DO ONLY ONE ROUND OF COMPUTE PERFORMANCE AND SAVE THE SCORE
-        self.loss = np.reshape(np.array(self.yloss
-                                            + (self.proximity_weight * self.proximity_loss) + (self.sparsity_weight * self.sparsity_loss)
-                            + (self.plausibility_weight * self.plausibility_loss)), (-1, 1))
-        index = np.reshape(np.arange(len(cfs)), (-1, 1))
-        self.loss = np.concatenate([index, self.loss], axis=1)
-        return self.loss
+        return self._compute_loss(cfs, desired_range, desired_class, include_conformance=False)
+
     def compute_loss(self, query_instance,cfs, desired_range, desired_class):
         """Computes the overall loss"""
-        ##TODO Fix proximity loss
-        self.yloss = self.compute_yloss(cfs, desired_range, desired_class)
-        self.proximity_loss = self.compute_proximity_loss(cfs, self.query_instance_normalized) \
-            if self.proximity_weight > 0 and len(self.data_interface.continuous_feature_indexes) > 1 else 0.0
-        self.sparsity_loss = self.compute_sparsity_loss(cfs) if self.sparsity_weight > 0 else 0.0
-        self.plausibility_loss = self.compute_plausibility(cfs = cfs)
-        #TODO DO ONLY ONE ROUND OF COMPUTE PERFORMANCE AND SAVE THE SCORE
-        self.loss = np.reshape(np.array(self.yloss
-                                        + (self.proximity_weight * self.proximity_loss) + (
-                                                    self.sparsity_weight * self.sparsity_loss)+
-                                            + (self.conformance_weight * (1 - self.conformance_score))
-                            + (self.plausibility_weight * self.plausibility_loss)), (-1, 1))
-
-        index = np.reshape(np.arange(len(cfs)), (-1, 1))
-        self.loss = np.concatenate([index, self.loss], axis=1)
-        return self.loss
+        return self._compute_loss(cfs, desired_range, desired_class, include_conformance=True)
+
     ### SHIFT FROM PARENT CONFORMANCE TO QUERY_INSTANCE CONFORMANCE
     #d4py.get_model_activities()
     #mate_2 represents the second heuristic, where we relax the contraints to include the targets that may occur
     #in the future
     def mate_2(self, k1, k2, features_to_vary, query_instance,encoder,d4py,activities,activations,targets):
         """Performs mating and produces new offsprings"""
-        # chromosome for offspring
-        k1df = pd.DataFrame([k1], columns=self.data_interface.feature_names)
-        k2df = pd.DataFrame([k2], columns=self.data_interface.feature_names)
-        original_query_df = pd.DataFrame(np.asarray(query_instance,dtype=float),columns=self.data_interface.feature_names)
-        encoder.decode(k1df)
-        encoder.decode(k2df)
-        encoder.decode(original_query_df)
-        one_init = np.zeros(self.data_interface.number_of_features)
-        prob = random.random()
-        filter_query = original_query_df[original_query_df.isin(activities)]
-        child = filter_query[filter_query.notnull()]
-        child = child.to_numpy().reshape(-1)
+        k1_decoded, k2_decoded, query_decoded = self._decode_rows(
+            np.vstack([k1, k2, np.asarray(query_instance, dtype=float).reshape(1, -1)]), encoder)
+        child = self._mate_2_decoded(k1, k2, k1_decoded, k2_decoded, query_decoded, features_to_vary,
+                                     query_instance, encoder, activities, activations)
+        return self._encode_rows(child.reshape(1, -1), encoder)
+
+    def _mate_2_decoded(self, k1, k2, k1_decoded, k2_decoded, query_decoded, features_to_vary, query_instance,
+                        encoder, activities, activations):
+        """mate_2() on parents that are already decoded by _decode_rows(); returns the decoded child."""
+        prob = self._rng.random()
+        # the activities of the query are kept, every other feature is filled in below
+        child = np.where(pd.Series(query_decoded).isin(activities).to_numpy(), query_decoded, np.nan)
 
         for j in range(self.data_interface.number_of_features):
             feat_name = self.data_interface.feature_names[j]
             if ('prefix' in feat_name) & (pd.isnull(child[j])):
-                if k1df[feat_name][0] not in activations:
-                    child[j] = k1df[feat_name][0]
-                elif k2df[feat_name][0] not in activations:
-                    child[j] = k2df[feat_name][0]
+                if k1_decoded[j] not in activations:
+                    child[j] = k1_decoded[j]
+                elif k2_decoded[j] not in activations:
+                    child[j] = k2_decoded[j]
                 else:
-                    child[j] = np.random.choice([x for x in encoder._label_dict[feat_name].keys() if x not in activations])
+                    child[j] = self._rng.choice([x for x in encoder._label_dict[feat_name].keys() if x not in activations])
             elif 'prefix' not in feat_name:
                 gp1 = k1[j]
                 gp2 = k2[j]
@@ -620,31 +1060,36 @@ class DiceGeneticConformance(ExplainerBase):
                 else:
                     # otherwise insert random gene(mutate) for maintaining diversity
                     if feat_name in features_to_vary:
-                        if feat_name in self.data_interface.continuous_feature_names:
-                            child[j] = np.random.uniform(self.feature_range[feat_name][0],
+                        if self._is_continuous[j]:
+                            child[j] = self._rng.uniform(self.feature_range[feat_name][0],
                                                          self.feature_range[feat_name][1])
                         else:
-                            child[j] = np.random.choice(self.feature_range[feat_name])
+                            child[j] = self._rng.choice(self.feature_range[feat_name])
                     else:
                         child[j] = query_instance[j]
             else:
                 pass
-        
-        child = pd.DataFrame([child], columns=self.data_interface.feature_names)
-        encoder.encode(child)
         return child
-    
+
+    def _decode_rows(self, rows, encoder):
+        """Decodes label-encoded rows with a single encoder.decode() call; returns an object array."""
+        rows_df = pd.DataFrame(rows, columns=self._feature_index)
+        encoder.decode(rows_df)
+        return rows_df.to_numpy(dtype=object)
+
+    def _encode_rows(self, rows, encoder):
+        """Inverse of _decode_rows(): encodes decoded rows with a single encoder.encode() call."""
+        rows_df = pd.DataFrame(rows, columns=self._feature_index)
+        encoder.encode(rows_df)
+        return rows_df
+
     #mate_1 represents the first heuristic where we do not use the activities again, no matter whether they are a target or not
     def mate_1(self, k1, k2, features_to_vary, query_instance, encoder, d4py, activities, activations, targets):
         """Performs mating and produces new offsprings"""
-        # chromosome for offspring
-        original_query_df = pd.DataFrame(np.asarray(query_instance,dtype=float),columns=self.data_interface.feature_names)
-        k1df = pd.DataFrame([k1], columns=self.data_interface.feature_names)
-        k2df = pd.DataFrame([k2], columns=self.data_interface.feature_names)
-        encoder.decode(k1df)
-        encoder.decode(k2df)
-        one_init = np.zeros(self.data_interface.number_of_features)
-        prob = random.random()
+        # unlike in mate_2, the query is kept label encoded
+        k1_decoded, k2_decoded = self._decode_rows(np.vstack([k1, k2]), encoder)
+        query_row = np.asarray(query_instance, dtype=float).reshape(-1).astype(object)
+        prob = self._rng.random()
         '''
         This chose the parent
         parent1df = k1df[k1df.isin(activities)]
@@ -656,19 +1101,17 @@ class DiceGeneticConformance(ExplainerBase):
         else:
             child = parent1df[parent1df.notnull()]
         '''
-        filter_query = original_query_df[original_query_df.isin(activities)]
-        child = filter_query[filter_query.notnull()]
-        child = child.to_numpy().reshape(-1)
+        child = np.where(pd.Series(query_row).isin(activities).to_numpy(), query_row, np.nan)
 
         for j in range(self.data_interface.number_of_features):
             feat_name = self.data_interface.feature_names[j]
             if 'prefix' in feat_name:
-                if k1df[feat_name][0] in activities:
-                    child[j] = k2df[feat_name][0]
-                elif k2df[feat_name][0] in activities:
-                    child[j] = k1df[feat_name][0]
+                if k1_decoded[j] in activities:
+                    child[j] = k2_decoded[j]
+                elif k2_decoded[j] in activities:
+                    child[j] = k1_decoded[j]
                 else:
-                    child[j] = np.random.choice([x for x in encoder._label_dict[feat_name].keys() if x not in activities])
+                    child[j] = self._rng.choice([x for x in encoder._label_dict[feat_name].keys() if x not in activities])
             elif 'prefix' not in feat_name:
                 gp1 = k1[j]
                 gp2 = k2[j]
@@ -681,19 +1124,17 @@ class DiceGeneticConformance(ExplainerBase):
                 else:
                     # otherwise insert random gene(mutate) for maintaining diversity
                     if feat_name in features_to_vary:
-                        if feat_name in self.data_interface.continuous_feature_names:
-                            child[j] = np.random.uniform(self.feature_range[feat_name][0],
+                        if self._is_continuous[j]:
+                            child[j] = self._rng.uniform(self.feature_range[feat_name][0],
                                                          self.feature_range[feat_name][1])
                         else:
-                            child[j] = np.random.choice(self.feature_range[feat_name])
+                            child[j] = self._rng.choice(self.feature_range[feat_name])
                     else:
                         child[j] = query_instance[j]
             else:
                 pass
 
-        child = pd.DataFrame([child], columns=self.data_interface.feature_names)
-        encoder.encode(child)
-        return child
+        return self._encode_rows(child.reshape(1, -1), encoder)
     def mate(self, k1, k2, features_to_vary, query_instance):
         """Performs mating and produces new offsprings"""
         # chromosome for offspring
@@ -704,7 +1145,7 @@ class DiceGeneticConformance(ExplainerBase):
             feat_name = self.data_interface.feature_names[j]
 
             # random probability
-            prob = random.random()
+            prob = self._rng.random()
 
             if prob < 0.40:
                 # if prob is less than 0.40, insert gene from parent 1
@@ -716,19 +1157,43 @@ class DiceGeneticConformance(ExplainerBase):
                 # otherwise insert random gene(mutate) for maintaining diversity
                 if feat_name in features_to_vary:
                     if feat_name in self.data_interface.continuous_feature_names:
-                        one_init[j] = np.random.uniform(self.feature_range[feat_name][0],
-                                                        self.feature_range[feat_name][0])
+                        one_init[j] = self._rng.uniform(self.feature_range[feat_name][0],
+                                                        self.feature_range[feat_name][1])
                     else:
-                        one_init[j] = np.random.choice(self.feature_range[feat_name])
+                        one_init[j] = self._rng.choice(self.feature_range[feat_name])
                 else:
                     one_init[j] = query_instance[j]
         return one_init
+    def mate_batch(self, parents1, parents2, features_to_vary, query_instance, out=None):
+        """Vectorized mate(): produces one offspring per pair of rows of parents1 and parents2."""
+        cache = self._get_random_init_cache(features_to_vary)
+        cont_idx, cat_idx = cache['cont_idx'], cache['cat_idx']
+        num_children = len(parents1)
+        if out is None:
+            out = np.empty(parents1.shape, dtype=np.float64)
+
+        # mutated genes are written to out first: fixed features keep the query value, like in mate(), and
+        # continuous genes are drawn from uniform(low, high) over the feature range
+        out[:] = np.where(cache['vary_mask'], 0.0, np.asarray(query_instance, dtype=float).reshape(-1))
+        if len(cont_idx) > 0:
+            out[:, cont_idx] = self._rng.uniform(cache['lo'], cache['hi'], size=(num_children, len(cont_idx)))
+        if len(cat_idx) > 0:
+            picks = (self._rng.random((num_children, len(cat_idx))) * cache['cat_sizes']).astype(np.intp)
+            out[:, cat_idx] = cache['cat_table'][np.arange(len(cat_idx)), picks]
+
+        # one random probability per gene: < 0.40 parent 1, < 0.80 parent 2, otherwise keep the mutation;
+        # the masked copies overwrite out in place instead of nesting np.where temporaries
+        prob = self._rng.random(parents1.shape)
+        np.copyto(out, parents2, where=prob < 0.80)
+        np.copyto(out, parents1, where=prob < 0.40)
+        return out
+
     def find_counterfactuals(self, query_instance, desired_range, desired_class,
                              features_to_vary, maxiterations, thresh, verbose,encoder,dataset,model_path,d4py,optimization,
                              heuristic,activities,activations,targets,adapted,activity_origin_position, activity_origin_name, conformance_penalty):
         """
         Finds counterfactuals by generating cfs through the genetic algorithm
-        
+
         Args:
             activity_origin_position: the position of the activity in the original log (to be compare with the position in the syntetic log)
             activity_origin_name: the name of the activity in the original log (to be compare with the position in the syntetic log)
@@ -742,8 +1207,11 @@ class DiceGeneticConformance(ExplainerBase):
         logger.debug(f"Activity original name received: {activity_origin_name}")
         logger.debug(f"Conformance penalty: {conformance_penalty}")
 
+        self._scores_cache.clear()
         population = self.cfs.copy()
         iterations = 0
+        # conformance of the final population, when it is a generation that was already evaluated
+        final_conformance = None
         previous_best_loss = -np.inf
         current_best_loss = np.inf
         stop_cnt = 0
@@ -752,27 +1220,26 @@ class DiceGeneticConformance(ExplainerBase):
 
         self.query_instance_normalized = self.data_interface.normalize_data(self.x1)
         self.query_instance_normalized = self.query_instance_normalized.astype('float')
+        # integer query and feature count used by compute_sparsity_loss in every generation
+        self._x1_int = np.asarray(self.x1, dtype=np.int64).ravel()
+        self._inv_nfeat = 1.0 / len(self.data_interface.feature_names)
+        if adapted:
+            # the query decoded once for every child of mate_2
+            query_decoded = self._decode_rows(np.asarray(query_instance, dtype=float).reshape(1, -1), encoder)[0]
 
         while iterations < maxiterations and self.total_CFs > 0:
             print("Iteration:", iterations)
-            if abs(previous_best_loss - current_best_loss) <= thresh and \
-                    (self.model.model_type == ModelTypes.Classifier and all(i == desired_class for i in cfs_preds) or
-                     (self.model.model_type == ModelTypes.Regressor and
-                      all(desired_range[0] <= i <= desired_range[1] for i in cfs_preds))):
-                stop_cnt += 1
-            else:
-                stop_cnt = 0
-            if stop_cnt >= 5:
-                print(f"Break {stop_cnt}")
-                break
             previous_best_loss = current_best_loss
-            population = np.unique(tuple(map(tuple, population)), axis=0) # the generated data
+            population = np.unique(population, axis=0) # the generated data
             ##TODO: Add conformance checking here before computing fitness
-            self.conformance_score, population_conformance = self.compute_conformance_new(population, encoder, d4py, activity_origin_position, activity_origin_name, conformance_penalty)
-            population_fitness = self.compute_loss(query_instance,population, desired_range, desired_class)
+            self.conformance_score, population_conformance = self._evaluate_population(population, encoder, d4py, activity_origin_position, activity_origin_name, conformance_penalty)
+            population_fitness = self._compute_loss(population, desired_range, desired_class,
+                                                    include_conformance=True,
+                                                    conformance_score=self.conformance_score)
             population_fitness = population_fitness[population_fitness[:, 1].argsort()]
             current_best_loss = population_fitness[0][1]
-            to_pred = np.array([population[int(tup[0])] for tup in population_fitness[:self.total_CFs]])
+            fitness_order = population_fitness[:, 0].astype(np.intp)
+            to_pred = population[fitness_order[:self.total_CFs]]
 
             if self.total_CFs > 0:
                 if self.model.model_type == ModelTypes.Classifier:
@@ -780,44 +1247,68 @@ class DiceGeneticConformance(ExplainerBase):
                 else:
                     cfs_preds = self.predict_fn(to_pred)
 
+            # the stopping criterion is checked as soon as the generation is evaluated, so that the last
+            # generation is not bred for nothing
+            if abs(previous_best_loss - current_best_loss) <= thresh and \
+                    (self.model.model_type == ModelTypes.Classifier and all(i == desired_class for i in cfs_preds) or
+                     (self.model.model_type == ModelTypes.Regressor and
+                      all(desired_range[0] <= i <= desired_range[1] for i in cfs_preds))):
+                stop_cnt += 1
+            else:
+                stop_cnt = 0
+            if stop_cnt >= 5:
+                print(f"Break {stop_cnt}")
+                # the evaluated generation, fittest first, is the final population
+                population = population[fitness_order]
+                final_conformance = self.conformance_score[fitness_order]
+                break
+
             # self.total_CFS of the next generation obtained from the fittest members of current generation
             top_members = self.total_CFs
-            new_generation_1 = np.array([population[int(tup[0])] for tup in population_fitness[:top_members]])
-
             # rest of the next generation obtained from top 50% of fittest members of current generation
             rest_members = self.population_size - top_members
-            new_generation_2 = None
-            if rest_members > 0:
-                new_generation_2 = np.zeros((rest_members, self.data_interface.number_of_features))
+            if rest_members <= 0:
+                raise SystemError("The number of total_Cfs is greater than the population size!")
+
+            # population comes from np.unique, so it never aliases the buffer the next generation is written to
+            num_top = min(top_members, len(fitness_order))
+            next_population = self._pop_buffer[:num_top + rest_members]
+            np.take(population, fitness_order[:num_top], axis=0, out=next_population[:num_top])
+            new_generation_2 = next_population[num_top:]
+
+            # parents are drawn from the first half of the population, bounds included
+            idx1 = self._rng.integers(0, int(len(population) / 2) + 1, size=rest_members)
+            idx2 = self._rng.integers(0, int(len(population) / 2) + 1, size=rest_members)
+            if adapted:
+                # the parents and the query are decoded once per generation and the children encoded at once
+                population_decoded = self._decode_rows(population, encoder)
+                children = np.empty((rest_members, population.shape[1]), dtype=object)
                 for new_gen_idx in range(rest_members):
-                    idx1 = random.randint(0,int(len(population) / 2))
-                    parent1 = population[idx1]
-                    idx2 = random.randint(0,int(len(population) / 2))
-                    parent2 = population[idx2]
                    # if heuristic == 'heuristic_1':
                    #     child = self.mate_1(parent1, parent2, features_to_vary, query_instance,encoder,d4py,activities,activations,targets)
-                    if adapted:
-                        child = self.mate_2(parent1, parent2, features_to_vary, query_instance,encoder,d4py,activities,activations,targets)
-                    else:
-                        child = self.mate(parent1, parent2, features_to_vary, query_instance)
-
-                    new_generation_2[new_gen_idx] = child
-
-            if new_generation_2 is not None:
-                #if self.total_CFs > 0:
-                population = np.concatenate([new_generation_1, new_generation_2])
-                #else:
-                #    population = new_generation_2
+                    i1, i2 = idx1[new_gen_idx], idx2[new_gen_idx]
+                    children[new_gen_idx] = self._mate_2_decoded(
+                        population[i1], population[i2], population_decoded[i1], population_decoded[i2],
+                        query_decoded, features_to_vary, query_instance, encoder, activities, activations)
+                new_generation_2[:] = self._encode_rows(children, encoder).to_numpy(dtype=np.float64)
             else:
-                raise SystemError("The number of total_Cfs is greater than the population size!")
+                self.mate_batch(population[idx1], population[idx2], features_to_vary, query_instance,
+                                out=new_generation_2)
+            population = next_population
             iterations += 1
-        
+
         logger.debug(f"Total iterations: {iterations}")
+        if population.base is self._pop_buffer:
+            # the final counterfactuals must not alias the buffer reused by the next query
+            population = population.copy()
 
         if optimization == 'filtering':
             #self.conformance_score, population_conformance, query_conformance = self.compute_conformance(
             #    query_instance, population, encoder, d4py)
-            self.conformance_score, population_conformance = self.compute_conformance_new(population, encoder,d4py, activity_origin_position, activity_origin_name, conformance_penalty)
+            if final_conformance is not None:
+                self.conformance_score = final_conformance
+            else:
+                self.conformance_score, population_conformance = self._evaluate_population(population, encoder,d4py, activity_origin_position, activity_origin_name, conformance_penalty)
             population = population[self.conformance_score > 0.99]
 
         self.cfs_preds = []
@@ -862,7 +1353,7 @@ class DiceGeneticConformance(ExplainerBase):
                       'Diverse Counterfactuals found for the given configuation, perhaps ',
                       'change the query instance or the features to vary...'  '; total time taken: %02d' % m,
                       'min %02d' % s, 'sec')
-        
+
         # print("query_instance_df")
         # print(query_instance_df.head()) # debug
 
@@ -876,37 +1367,42 @@ class DiceGeneticConformance(ExplainerBase):
     def label_decode(self, labelled_input):
         """Transforms label encoded data back to categorical values
         """
-        num_to_decode = 1
-        if len(labelled_input.shape) > 1:
-            num_to_decode = len(labelled_input)
-        else:
-            labelled_input = [labelled_input]
-
-        input_instance = []
-
-        for j in range(num_to_decode):
-            temp = {}
-            for i in range(len(labelled_input[j])):
-                if self.data_interface.feature_names[i] in self.data_interface.categorical_feature_names:
-                    enc = self.labelencoder[self.data_interface.feature_names[i]]
-                    val = enc.inverse_transform(np.array([labelled_input[j][i]], dtype=np.int32))
-                    temp[self.data_interface.feature_names[i]] = val[0]
-                else:
-                    temp[self.data_interface.feature_names[i]] = labelled_input[j][i]
-            input_instance.append(temp)
-        input_instance_df = pd.DataFrame(input_instance, columns=self.data_interface.feature_names)
+        labelled_input = np.asarray(labelled_input)
+        if len(labelled_input.shape) == 1:
+            labelled_input = labelled_input.reshape(1, -1)
+
+        # one table lookup per categorical column, over all the rows at once
+        categorical_features = set(self.data_interface.categorical_feature_names)
+        columns = {}
+        for i, feature in enumerate(self.data_interface.feature_names):
+            if feature in categorical_features:
+                classes = self._get_inverse_table(feature)
+                labels = labelled_input[:, i].astype(np.intp)
+                # negative labels would wrap around instead of failing like LabelEncoder.inverse_transform
+                unseen = (labels < 0) | (labels >= len(classes))
+                if unseen.any():
+                    raise ValueError("y contains previously unseen labels: {0}".format(np.unique(labels[unseen])))
+                columns[feature] = classes[labels]
+            else:
+                columns[feature] = labelled_input[:, i]
+        input_instance_df = pd.DataFrame(columns, columns=self.data_interface.feature_names)
         return input_instance_df
 
+    def _get_inverse_table(self, feature):
+        """Returns the classes of the label encoder of feature, so that classes[label] inverts the encoding."""
+        if self._inv_table_owner is not self.labelencoder:
+            self._inv_table = {}
+            self._inv_table_owner = self.labelencoder
+        if feature not in self._inv_table:
+            self._inv_table[feature] = np.asarray(self.labelencoder[feature].classes_)
+        return self._inv_table[feature]
+
     def label_decode_cfs(self, cfs_arr):
-        ret_df = None
-        if cfs_arr is None:
+        if cfs_arr is None or len(cfs_arr) == 0:
             return None
-        for cf in cfs_arr:
-            df = self.label_decode(cf)
-            if ret_df is None:
-                ret_df = df
-            else:
-                ret_df = pd.concat([ret_df, df])
+        ret_df = self.label_decode(np.asarray(cfs_arr))
+        # every row keeps the index 0 it had when the cfs were decoded and concatenated one at a time
+        ret_df.index = np.zeros(len(ret_df), dtype=np.int64)
         return ret_df
 
     def get_valid_feature_range(self, normalized=False):
@@ -917,37 +1413,16 @@ class DiceGeneticConformance(ExplainerBase):
         return ret
 
     def compute_conformance(self,query_instance,population,encoder,d4py):
-        population_df = pd.DataFrame(population, columns=self.data_interface.feature_names)
-        query_instance_to_decode = pd.DataFrame(np.array(query_instance,dtype=float), columns=self.data_interface.feature_names)
-        encoder.decode(query_instance_to_decode)
-        encoder.decode(population_df)
-        population_df.insert(loc=0, column='Case ID', value=np.divmod(np.arange(len(population_df)), 1)[0] + 1)
-        population_df.insert(loc=1, column='label', value=1)
-        query_instance_to_decode.insert(loc=0, column='Case ID', value=np.divmod(np.arange(len(query_instance_to_decode)), 1)[0] + 1)
-        query_instance_to_decode.insert(loc=1, column='label', value=1)
-        long_data = pd.wide_to_long(population_df, stubnames=['prefix'], i='Case ID',
-                                    j='order', sep='_', suffix=r'\w+')
-        long_query_instance = pd.wide_to_long(query_instance_to_decode, stubnames=['prefix'], i='Case ID',
-                                              j='order', sep='_', suffix=r'\w+')
-        long_query_instance_sorted = long_query_instance.sort_values(['Case ID', 'order'], ).reset_index(drop=False)
-        timestamps = pd.date_range('1/1/2011', periods=len(long_data), freq='H')
-        long_data_sorted = long_data.sort_values(['Case ID', 'order'], ).reset_index(drop=False)
-        long_data_sorted['time:timestamp'] = timestamps
-        long_data_sorted['label'].replace({1: 'regular'}, inplace=True)
-        long_data_sorted.drop(columns=['order'], inplace=True)
-        columns_to_rename = {'Case ID': 'case:concept:name','prefix': 'concept:name'}
-        long_data_sorted.rename(columns=columns_to_rename, inplace=True)
-        long_data_sorted['label'].replace({'regular': 'false', 'deviant': 'true'}, inplace=True)
-        long_data_sorted.replace('0', 'other', inplace=True)
-        long_query_instance_sorted.rename(columns=columns_to_rename, inplace=True)
-        long_query_instance_sorted['label'].replace({'regular': 'false', 'deviant': 'true'}, inplace=True)
-        long_query_instance_sorted.replace('0', 'other', inplace=True)
-        event_log = pm4py.convert_to_event_log(long_data_sorted)
-        query_log = pm4py.convert_to_event_log(long_query_instance_sorted)
+        from declare4py.enums import TraceState
+
+        # the query is appended to the population as its last case, so that one log is loaded and checked
+        population = np.asarray(population, dtype=float)
+        query_row = np.asarray(query_instance, dtype=float).reshape(1, -1)
+        event_log, _ = self._build_event_log(np.vstack([population, query_row]), encoder)
         d4py.load_xes_log(event_log)
-        model_check_res = d4py.conformance_checking(consider_vacuity=False)
-        d4py.load_xes_log(query_log)
-        model_check_query = d4py.conformance_checking(consider_vacuity=False)
+        check_res = list(d4py.conformance_checking(consider_vacuity=False).items())
+        model_check_res = dict(check_res[:len(population)])
+        model_check_query = dict(check_res[len(population):])
         query_patterns = {
             constraint
             for trace, patts in model_check_query.items()
@@ -967,6 +1442,21 @@ class DiceGeneticConformance(ExplainerBase):
         conformance_score = np.array([len(v) / len(query_patterns) for  v in model_check_res.values()])
         return conformance_score,model_check_res,query_patterns
 
+    def _wide_to_long(self, wide_df):
+        """Turns one row per case with prefix_<n> columns into one row per (case, prefix) event.
+
+        Equivalent to pd.wide_to_long on the 'prefix' stub followed by a sort on ('Case ID', 'order'), built with
+        numpy repeat/ravel since the rows are already ordered by case and the prefix columns by position.
+        """
+        num_cases, num_prefixes = len(wide_df), len(self._prefix_cols)
+        long_columns = {'Case ID': np.repeat(wide_df['Case ID'].to_numpy(), num_prefixes),
+                        'order': np.tile(self._prefix_order, num_cases)}
+        for column in wide_df.columns:
+            if column != 'Case ID' and column not in self._prefix_cols:
+                long_columns[column] = np.repeat(wide_df[column].to_numpy(), num_prefixes)
+        long_columns['prefix'] = wide_df[self._prefix_cols].to_numpy().ravel()
+        return pd.DataFrame(long_columns)
+
     def get_constraint_activities(self,d4py):
         activations = set()
         targets = set()
@@ -984,6 +1474,8 @@ class DiceGeneticConformance(ExplainerBase):
         return activities, activations, targets
 
     def filter_declare_model(self,query_instance,encoder,d4py):
+        from declare4py.enums import TraceState
+
         query_instance_to_decode = pd.DataFrame(np.array(query_instance, dtype=float),
                                                 columns=self.data_interface.feature_names)
         encoder.decode(query_instance_to_decode)
@@ -991,18 +1483,14 @@ class DiceGeneticConformance(ExplainerBase):
         query_instance_to_decode.insert(loc=0, column='Case ID',
                                         value=np.divmod(np.arange(len(query_instance_to_decode)), 1)[0] + 1)
         query_instance_to_decode.insert(loc=1, column='label', value=1)
-        long_query_instance = pd.wide_to_long(query_instance_to_decode, stubnames=['prefix'], i='Case ID',
-                                              j='order', sep='_', suffix=r'\w+')
-
-        long_query_instance_sorted = long_query_instance.sort_values(['Case ID', 'order'], ).reset_index(drop=False)
-        columns_to_rename = {'Case ID': 'case:concept:name', 'prefix': 'concept:name'}
-        timestamps = pd.date_range('1/1/2011', periods=len(long_query_instance), freq='H')
+        long_query_instance_sorted = self._wide_to_long(query_instance_to_decode)
+        timestamps = _timestamps(len(long_query_instance_sorted))
         long_query_instance_sorted['time:timestamp'] = timestamps
-        long_query_instance_sorted.rename(columns=columns_to_rename, inplace=True)
+        long_query_instance_sorted.rename(columns=_COLUMNS_TO_RENAME, inplace=True)
         long_query_instance_sorted['label'].replace({'regular': 'false', 'deviant': 'true'}, inplace=True)
         long_query_instance_sorted.replace('0', 'other', inplace=True)
         long_query_instance_sorted['case:concept:name']=long_query_instance_sorted['case:concept:name'].astype(str)
-        query_log = pm4py.convert_to_event_log(long_query_instance_sorted)
+        query_log = _to_event_log(long_query_instance_sorted)
         d4py.load_xes_log(query_log)
         model_check_query = d4py.conformance_checking(consider_vacuity=False)
         query_patterns = {
@@ -1032,57 +1520,84 @@ class DiceGeneticConformance(ExplainerBase):
         d4py.model.constraints = updated_constraints
 
     def compute_conformance_new(self, population, encoder, d4py, activity_origin_position, activity_origin_name, conformance_penalty):
+        """Conformance of every individual of population, reusing the results of the individuals seen before.
+
+        The individuals not seen before are scored in n_jobs chunks of cases, see _evaluate_rows().
         """
+        return self._memoized_conformance(population, encoder, d4py, activity_origin_position, activity_origin_name,
+                                          conformance_penalty, self._evaluate_rows)
+
+    def _build_event_log(self, population, encoder):
+        """Builds the pm4py event log with one case per row of population, and the long DataFrame it comes from."""
+        population_df = pd.DataFrame(population, columns=self.data_interface.feature_names)
+        encoder.decode(population_df)
+        population_df.insert(loc=0, column='Case ID', value=np.divmod(np.arange(len(population_df)), 1)[0] + 1)
+        # every synthetic case is regular, i.e. labelled 'false'
+        population_df.insert(loc=1, column='label', value='false')
+        long_data_sorted = self._wide_to_long(population_df)
+        timestamps = _timestamps(len(long_data_sorted))
+        long_data_sorted['time:timestamp'] = timestamps
+        long_data_sorted.drop(columns=['order'], inplace=True)
+        long_data_sorted.rename(columns=_COLUMNS_TO_RENAME, inplace=True)
+        # only the decoded (object) columns can hold the '0' padding label
+        for column in long_data_sorted.columns[long_data_sorted.dtypes == object]:
+            if column != 'label':
+                values = long_data_sorted[column].to_numpy()
+                long_data_sorted[column] = np.where(values == '0', 'other', values)
+        # the low-cardinality columns as categories: the case ids are turned into strings once per case, and
+        # the activities are compared through their integer codes below
+        long_data_sorted['label'] = pd.Categorical.from_codes(np.zeros(len(long_data_sorted), dtype=np.int8),
+                                                              categories=['false'])
+        case_ids = pd.Categorical(long_data_sorted['case:concept:name'])
+        long_data_sorted['case:concept:name'] = case_ids.rename_categories(case_ids.categories.astype(str))
+        long_data_sorted['concept:name'] = long_data_sorted['concept:name'].astype('category')
+        return _to_event_log(long_data_sorted), long_data_sorted
+
+    def _compute_conformance_rows(self, population, encoder, d4py, activity_origin_position, activity_origin_name, conformance_penalty):
+        """Conformance of every row of population, one case per row, scored and penalized in vectorized passes.
+
+        This is the unit of work of the parallel evaluation: _evaluate_rows() splits the population into one
+        chunk per worker and calls it on every chunk, so the cases are never dispatched one at a time.
+
         Args:
             activity_origin_position: the position of the activity in the original log (to be compare with the position in the syntetic log)
             activity_origin_name: the name of the activity in the original log (to be compare with the position in the syntetic log)
             conformance_penalty: the penalty to be applied
         """
+        from declare4py.enums import TraceState
+
         logger.debug("compute_conformance_new()")
-        logger.debug(f"Activity original position received: {activity_origin_position}")
-        logger.debug(f"Activity original name received: {activity_origin_name}")
-        
-        population_df = pd.DataFrame(population, columns=self.data_interface.feature_names)
-        encoder.decode(population_df)
-        population_df.insert(loc=0, column='Case ID', value=np.divmod(np.arange(len(population_df)), 1)[0] + 1)
-        population_df.insert(loc=1, column='label', value=1)
-        long_data = pd.wide_to_long(population_df, stubnames=['prefix'], i='Case ID',
-                                    j='order', sep='_', suffix=r'\w+')
-        timestamps = pd.date_range('1/1/2011', periods=len(long_data), freq='H')
-        long_data_sorted = long_data.sort_values(['Case ID', 'order'], ).reset_index(drop=False)
-        long_data_sorted['time:timestamp'] = timestamps
-        long_data_sorted['label'].replace({1: 'regular'}, inplace=True)
-        long_data_sorted.drop(columns=['order'], inplace=True)
-        columns_to_rename = {'Case ID': 'case:concept:name', 'prefix': 'concept:name'}
-        long_data_sorted.rename(columns=columns_to_rename, inplace=True)
-        long_data_sorted['label'].replace({'regular': 'false', 'deviant': 'true'}, inplace=True)
-        long_data_sorted.replace('0', 'other', inplace=True)
-        long_data_sorted['case:concept:name'] = long_data_sorted['case:concept:name'].astype(str)
-        event_log = pm4py.convert_to_event_log(long_data_sorted)
+        logger.debug("Activity original position received: %s", activity_origin_position)
+        logger.debug("Activity original name received: %s", activity_origin_name)
+
+        event_log, long_data_sorted = self._build_event_log(population, encoder)
         d4py.load_xes_log(event_log)
         model_check_res = d4py.conformance_checking(consider_vacuity=False)
 
-        # [2025-02-07]: added log_converter
-        event_log_df = log_converter.apply(event_log, variant=log_converter.Variants.TO_DATA_FRAME) 
-        # print(event_log_df.head())
-        event_log_df.to_csv("test.csv", sep=";", index=False)
-        # print("--")
-        
-        cases_num = event_log_df["case:concept:name"].nunique()
-        cases_list = event_log_df["case:concept:name"].unique()
-        print(f"Distinct cases ({cases_num}): {cases_list}")
-
-        model_check_res_filter = {
-            k: {
-                constraint: checker
-                for constraint, checker in v.items()
-                if checker.state != TraceState.VIOLATED
-            }
-            for k, v in model_check_res.items()
-        }
-
-        conformance_score = np.array([len(v) / len(model_check_res.get(k).values()) for k,v in model_check_res_filter.items()])
-        print(f"conformance_score *old* ({len(conformance_score)}): {conformance_score}")
+        # the long log already holds the events in the order of the event log
+        event_log_df = long_data_sorted
+
+        # case of every event as an index into cases_list, taken from the categorical case ids without
+        # another pass over the column; the case ids increase with the rows, so the categories are in
+        # order of appearance
+        case_ids = event_log_df["case:concept:name"].cat
+        case_codes, cases_list = case_ids.codes.to_numpy(), case_ids.categories
+        logger.debug("Distinct cases (%d): %s", len(cases_list), cases_list)
+
+        # fraction of the constraints of each case that are not violated
+        # float32 is plenty for a fitness term and halves the bytes of the score arrays
+        conformance_score = np.empty(len(model_check_res), dtype=np.float32)
+        violated = TraceState.VIOLATED
+        for i, checkers in enumerate(model_check_res.values()):
+            # the total comes with the checker dict of the case, only the violations are counted;
+            # enum members are singletons, so the identity test is enough
+            total = len(checkers)
+            if total == 0:
+                conformance_score[i] = 0.0
+                continue
+            violations = sum(checker.state is violated for checker in checkers.values())
+            conformance_score[i] = (total - violations) / total
+        logger.debug("conformance_score *old* (%d): %s", len(conformance_score), conformance_score)
 
         ###
         # New version of the conformance score: for each case-id, check te position of the activity_origin_name
@@ -1091,34 +1606,150 @@ class DiceGeneticConformance(ExplainerBase):
         # 2. the target activity does not exist in the generated traces
         ###
 
-        case_column = "case:concept:name"
-        for i, case_value in enumerate(cases_list):
-            punish = 0
-            df_synth_filtered = event_log_df[event_log_df[case_column] == case_value]
-            # task: find the activity_origin_name and its position in df_filtered
-            print("--")
-            print(f"Updating conformance score of position {i}")
-            activity_synth_position = find_activity_position_by_name(df_synth_filtered, "concept:name", activity_origin_name)
-            print(f"Activity '{activity_origin_name}' new syntetic position: {activity_synth_position}")
-            if activity_origin_position == activity_synth_position:
-                print(f"Activity original position {activity_origin_position} and synthetic positions are same {activity_synth_position}")
-                punish = conformance_penalty
-            if activity_synth_position == -1:
-                print(f"Activity original position {activity_origin_position} but synthetic positions not found {activity_synth_position}")
-                punish = conformance_penalty
+        # the events are grouped by case and the cases sorted by code, so the first hit of a case is its first
+        # entry in the (sorted) codes of the hits, and its position is counted from the first event of the case
+        activities = event_log_df["concept:name"].cat
+        activity_code = activities.categories.get_indexer([activity_origin_name])[0]
+        if activity_code == -1:
+            hits = np.empty(0, dtype=np.intp)
+        else:
+            hits = np.flatnonzero(activities.codes.to_numpy() == activity_code)
+        hit_cases, first_hits = np.unique(case_codes[hits], return_index=True)
+        case_starts = np.searchsorted(case_codes, hit_cases, side='left')
+        # first position of activity_origin_name within each case, -1 when the case does not contain it
+        activity_synth_position = np.full(len(cases_list), -1, dtype=np.intp)
+        activity_synth_position[hit_cases] = hits[first_hits] - case_starts
+        # a case is punished once, whether the activity is missing or at its original position
+        punish = activity_synth_position == -1
+        if activity_origin_position != -1:
+            punish |= activity_synth_position == activity_origin_position
+        # a penalty that is not a number raises here, as the per-case subtraction did
+        conformance_score[punish] -= conformance_penalty
+
+        logger.debug("conformance_score *new* (%d): %s", len(conformance_score), conformance_score)
+
+        return conformance_score, model_check_res
 
-            conformance_score[i] -= punish
+# (explainer, encoder, declare model, penalty settings) of a conformance worker, see _init_conformance_worker()
+_worker_state = None
+
+
+def _init_conformance_worker(explainer, encoder, d4py, activity_origin_position, activity_origin_name,
+                             conformance_penalty):
+    """Keeps the state handed to the worker by _start_conformance_pool()."""
+    global _worker_state
+    _worker_state = (explainer, encoder, d4py, activity_origin_position, activity_origin_name, conformance_penalty)
+
+
+def _evaluate_pooled_chunk(chunk):
+    """Scores one chunk of the population in a pool worker, with the state set by _init_conformance_worker()."""
+    explainer, encoder, d4py, activity_origin_position, activity_origin_name, conformance_penalty = _worker_state
+    return _evaluate_chunk(explainer, chunk, encoder, d4py, activity_origin_position, activity_origin_name,
+                           conformance_penalty)
+
+
+def _evaluate_chunk(explainer, chunk, encoder, d4py, activity_origin_position, activity_origin_name,
+                    conformance_penalty):
+    """Scores one chunk of the population in a worker; d4py is the worker's own copy of the declare model."""
+    scores = explainer._predict_scores_from_array(chunk)
+    conformance_score, model_check_res = explainer._compute_conformance_rows(
+        chunk, encoder, d4py, activity_origin_position, activity_origin_name, conformance_penalty)
+    return scores, conformance_score, model_check_res
+
+
+# hourly timestamps from 2011-01-01, grown on demand by _timestamps()
+_timestamp_pool = np.empty(0, dtype='datetime64[ns]')
+
+
+def _timestamps(num_events):
+    """Hourly timestamps given to the events of a synthetic log, as a read-only view of a shared pool.
+
+    The timestamps only order the events, so every log takes the first num_events of the same sequence.
+    """
+    global _timestamp_pool
+    if len(_timestamp_pool) < num_events:
+        pool_size = max(num_events, 2 * len(_timestamp_pool))
+        _timestamp_pool = np.datetime64('2011-01-01', 'ns') + np.arange(pool_size) * np.timedelta64(1, 'h')
+        _timestamp_pool.flags.writeable = False
+    return _timestamp_pool[:num_events]
+
+
+def _to_event_log(long_df):
+    """Builds the pm4py EventLog of a long-format log without pm4py's DataFrame checks.
+
+    Like pm4py.convert_to_event_log, the case:* columns become trace attributes (taken from the first event of
+    the case) and the other columns become event attributes, the events are grouped by case id with the traces
+    in order of first appearance, and missing (NaN) attribute values are dropped.
+    """
+    from pm4py.objects.log.obj import Event, EventLog, Trace
+
+    case_columns = [column for column in long_df.columns if column.startswith('case:')]
+    event_columns = [column for column in long_df.columns if not column.startswith('case:')]
+    # only the columns that have missing values need filtering
+    case_nan = {column for column in case_columns if long_df[column].isna().any()}
+    event_nan = {column for column in event_columns if long_df[column].isna().any()}
+    case_values = zip(*[long_df[column].tolist() for column in case_columns])
+    event_values = zip(*[long_df[column].tolist() for column in event_columns])
+    case_id_pos = case_columns.index(_COLUMNS_TO_RENAME['Case ID'])
+
+    event_log = EventLog()
+    traces = {}
+    trace_id = None
+    trace = None
+    for case_row, event_row in zip(case_values, event_values):
+        if trace is None or case_row[case_id_pos] != trace_id:
+            trace_id = case_row[case_id_pos]
+            trace = traces.get(trace_id)
+            if trace is None:
+                trace = Trace(attributes={column[len('case:'):]: value for column, value in zip(case_columns, case_row)
+                                          if column not in case_nan or not _is_nan(value)})
+                traces[trace_id] = trace
+                event_log.append(trace)
+        if event_nan:
+            trace.append(Event((column, value) for column, value in zip(event_columns, event_row)
+                               if column not in event_nan or not _is_nan(value)))
+        else:
+            trace.append(Event(zip(event_columns, event_row)))
+    return event_log
 
-            print(f"conformance_score *new* ({len(conformance_score)}): {conformance_score}")
 
-        # quit()
+def _is_nan(value):
+    """Whether value is a float NaN, the missing values pm4py drops when converting a DataFrame to a log."""
+    return isinstance(value, float) and value != value
+
+
+def _shift_case_key(case_key, offset):
+    """Moves a conformance result key, a case id or a (trace index, case id) pair, by offset cases."""
+    if isinstance(case_key, tuple):
+        return (case_key[0] + offset, str(int(case_key[1]) + offset))
+    return str(int(case_key) + offset)
 
-        return conformance_score, model_check_res
 
 def mad_cityblock(u, v, mad):
     u = _validate_vector(u)
     v = _validate_vector(v)
+    inv_mad = np.reciprocal(np.broadcast_to(np.asarray(mad, dtype=np.float64), u.shape))
+    return mad_cityblock_fast(np.ascontiguousarray(u, dtype=np.float64), np.ascontiguousarray(v, dtype=np.float64),
+                              inv_mad)
+
+
+def mad_cityblock_fast(u, v, inv_mad):
+    """mad_cityblock without the input validation, for C-contiguous float64 vectors of the same length.
+
+    Takes inv_mad = 1 / mad, so that callers measuring many distances invert the MADs once.
+    """
+    assert u.flags['C_CONTIGUOUS'] and u.dtype == np.float64, 'u must be a C-contiguous float64 vector'
+    if _dist_numba.NUMBA_AVAILABLE:
+        # subtraction, scaling and sum fused in one pass, without the two temporaries below
+        return _dist_numba.mad_cityblock(u, v, inv_mad)
     l1_diff = abs(u - v)
-    l1_diff_mad = l1_diff / mad
+    l1_diff_mad = l1_diff * inv_mad
     return l1_diff_mad.sum()
 
+
+def mad_cityblock_batch(cf_list, query, inv_mad):
+    """mad_cityblock between every row of cf_list and query, as one array; inv_mad = 1 / mad."""
+    if _dist_numba.NUMBA_AVAILABLE:
+        return _dist_numba.mad_cityblock_batch(np.ascontiguousarray(cf_list), np.ascontiguousarray(query),
+                                               np.ascontiguousarray(np.broadcast_to(inv_mad, query.shape)))
+    return (np.abs(cf_list - query) * inv_mad).sum(axis=1)
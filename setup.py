@@ -9,8 +9,8 @@ with open("README.rst", "r") as fh:
 with open('requirements.txt', encoding='utf-8') as f:
     install_requires = f.read().splitlines()
 
-# Deep learning packages are optional to install
-extras = ["deeplearning"]
+# Deep learning packages and numba (for the compiled distance kernels) are optional to install
+extras = ["deeplearning", "numba"]
 extras_require = dict()
 for e in extras:
     req_file = "requirements-{0}.txt".format(e)
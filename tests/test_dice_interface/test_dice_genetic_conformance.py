@@ -0,0 +1,535 @@
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.preprocessing import LabelEncoder
+
+import dice_ml
+from dice_ml.explainer_interfaces.dice_genetic_conformance import (
+    DiceGeneticConformance, _to_event_log, mad_cityblock_batch,
+    mad_cityblock_fast)
+from dice_ml.utils import _dist_numba
+from dice_ml.utils.exception import UserConfigValidationException
+
+PREFIX_LEVELS = {'prefix_1': 4, 'prefix_2': 5}
+
+
+class FakeTemplate:
+    def __init__(self, supports_cardinality, is_binary):
+        self.supports_cardinality = supports_cardinality
+        self.is_binary = is_binary
+
+
+class FakeChecker:
+    def __init__(self, state):
+        self.state = state
+
+
+class FakeDeclareModel:
+    def __init__(self):
+        self.constraints = ['Existence1[a1]', 'Absence2[a3]', 'Response[a0, a2]', 'Existence1[a4]']
+        self.checkers = [{'template': FakeTemplate(True, False), 'attributes': 'a1'},
+                         {'template': FakeTemplate(True, False), 'attributes': 'a3'},
+                         {'template': FakeTemplate(False, True), 'attributes': 'a0, a2'},
+                         {'template': FakeTemplate(True, False), 'attributes': 'a4'}]
+
+
+class FakeDeclare4Py:
+    """Checks Existence, Absence and Response constraints, standing in for declare4py's conformance checking."""
+    def __init__(self):
+        self.model = FakeDeclareModel()
+        self.log = None
+
+    def parse_decl_model(self, path):
+        self.model = FakeDeclareModel()
+
+    def load_xes_log(self, log):
+        self.log = log
+
+    def conformance_checking(self, consider_vacuity=False):
+        from declare4py.enums import TraceState
+
+        results = {}
+        for trace in self.log:
+            activities = [event['concept:name'] for event in trace]
+            trace_results = {}
+            for constraint in self.model.constraints:
+                template = constraint.split('[')[0]
+                args = constraint[constraint.index('[') + 1:-1].replace(' ', '').split(',')
+                if template.startswith('Existence'):
+                    satisfied = args[0] in activities
+                elif template.startswith('Absence'):
+                    satisfied = activities.count(args[0]) < 2
+                else:
+                    satisfied = args[0] not in activities or args[1] in activities[activities.index(args[0]):]
+                state = TraceState.SATISFIED if satisfied else TraceState.VIOLATED
+                trace_results[constraint] = FakeChecker(state)
+            results[trace.attributes['concept:name']] = trace_results
+        return results
+
+
+class FakeEncoder:
+    """Label encoder of the prefix columns; code 0 is the padding activity '0'."""
+    def __init__(self):
+        self._label_dict = {column: {('a%d' % code if code else '0'): code for code in range(levels)}
+                            for column, levels in PREFIX_LEVELS.items()}
+
+    def decode(self, df):
+        for column, labels in self._label_dict.items():
+            inverse = {code: label for label, code in labels.items()}
+            df[column] = [inverse.get(int(float(value)), '0') for value in df[column]]
+
+    def encode(self, df):
+        for column, labels in self._label_dict.items():
+            df[column] = [labels.get(value, 0) for value in df[column]]
+
+
+@pytest.fixture()
+def conformance_dataset():
+    rng = np.random.RandomState(0)
+    num_rows = 300
+    dataset = pd.DataFrame({'age': rng.randint(18, 80, num_rows),
+                            'hours': rng.uniform(1, 60, num_rows).round(1),
+                            'prefix_1': rng.randint(0, PREFIX_LEVELS['prefix_1'], num_rows),
+                            'prefix_2': rng.randint(0, PREFIX_LEVELS['prefix_2'], num_rows),
+                            'color': rng.randint(0, 3, num_rows)})
+    dataset['label'] = ((dataset.age > 40) ^ (dataset.prefix_1 == 2)).astype(int)
+    return dataset
+
+
+@pytest.fixture()
+def conformance_exp_object(conformance_dataset):
+    d = dice_ml.Data(dataframe=conformance_dataset, continuous_features=['age', 'hours'], outcome_name='label')
+    clf = RandomForestClassifier(n_estimators=10, random_state=0)
+    clf.fit(conformance_dataset.drop(columns='label'), conformance_dataset.label)
+    m = dice_ml.Model(model=clf, backend='sklearn')
+    return DiceGeneticConformance(d, m)
+
+
+@pytest.fixture()
+def initialized_exp_object(conformance_exp_object, conformance_dataset):
+    """The explainer in the state find_counterfactuals starts from, for a query of the conformance dataset."""
+    exp = conformance_exp_object
+    query_instance = conformance_dataset.iloc[[3]].drop(columns='label')
+    exp.data_interface.set_continuous_feature_indexes(query_instance)
+    features_to_vary = exp.setup('all', None, query_instance, 'inverse_mad')
+    query_instance = exp.data_interface.prepare_query_instance(query_instance=query_instance)
+    exp.num_output_nodes = exp.model.get_num_output_nodes2(query_instance)
+    exp.x1 = query_instance.to_numpy()[0]
+    exp.test_pred = exp.predict_fn(exp.x1.reshape(1, -1))
+    desired_class = exp.misc_init(0.25, 'opposite', None, exp.test_pred)
+    exp.population_size = 30
+    exp.do_param_initializations(2, 'kdtree', None, desired_class, exp.x1.reshape(1, -1),
+                                 exp._encode_dummies(query_instance), 'DiverseCF', features_to_vary, None,
+                                 'hinge_loss', 'dpp_style:inverse_dist', 'inverse_mad', 0.5, 0.5, 0.0, 0.5, 0.1, 3,
+                                 None, False)
+    exp.query_instance_normalized = exp.data_interface.normalize_data(exp.x1).astype('float')
+    exp._x1_int = np.asarray(exp.x1, dtype=np.int64).ravel()
+    exp._inv_nfeat = 1.0 / len(exp.data_interface.feature_names)
+    return exp, desired_class
+
+
+@pytest.fixture()
+def conformance_population(conformance_dataset):
+    """Rows of the conformance dataset with perturbed continuous features, a few of them far out of range."""
+    rng = np.random.RandomState(1)
+    population = conformance_dataset.drop(columns='label').sample(40, random_state=1).to_numpy(dtype=np.float64)
+    population[:, 1] += rng.uniform(-5, 5, len(population)).round(1)
+    population[:3, 0] = [123456789, 3e9, 2 ** 31]
+    return np.ascontiguousarray(population)
+
+
+@pytest.fixture()
+def declare_model_path(tmp_path, monkeypatch):
+    pytest.importorskip('pm4py')
+    pytest.importorskip('declare4py.declare4py')
+    monkeypatch.setattr('declare4py.declare4py.Declare4Py', FakeDeclare4Py)
+    (tmp_path / 'fake.decl').write_text('')
+    return str(tmp_path)
+
+
+class TestDiceGeneticConformance:
+    @pytest.fixture(autouse=True)
+    def _initiate_exp_object(self, conformance_exp_object, conformance_dataset, declare_model_path):
+        self.exp = conformance_exp_object
+        self.dataset = conformance_dataset
+        self.model_path = declare_model_path
+        self.encoder = FakeEncoder()
+
+    def _generate(self, n_jobs, conformance_penalty=0.1, total_CFs=2):
+        query_instance = self.dataset.iloc[[3]].drop(columns='label')
+        self.exp.data_interface.set_continuous_feature_indexes(query_instance)
+        np.random.seed(0)
+        return self.exp._generate_counterfactuals(query_instance, total_CFs, self.encoder, 'fake', model_path=self.model_path,
+                                                  random_seed=0, maxiterations=15, activity_origin_position=0,
+                                                  activity_origin_name='a1', conformance_penalty=conformance_penalty,
+                                                  verbose=False, n_jobs=n_jobs)
+
+    # The worker processes must score the population exactly as the parent does; total_CFs=3 gives a
+    # population of 45, which n_jobs=2 splits into uneven chunks
+    def test_parallel_matches_serial(self):
+        serial = self._generate(n_jobs=1, total_CFs=3)
+        parallel = self._generate(n_jobs=2, total_CFs=3)
+        assert self.exp._pool is None
+        assert self.exp.population_size == 45
+        pd.testing.assert_frame_equal(parallel.final_cfs_df, serial.final_cfs_df)
+
+    # The conformance memo is only reused within a query
+    def test_conformance_memo_cleared_per_query(self):
+        self._generate(n_jobs=1)
+        self.exp._conf_cache[b'stale'] = None
+        self._generate(n_jobs=1)
+        assert b'stale' not in self.exp._conf_cache
+        assert len(self.exp._conf_cache) > 0
+
+    # The plateau criterion is checked as soon as a generation is evaluated: the search stops after five
+    # evaluations without improvement, without breeding a generation from the last one, and returns it
+    def test_stop_criterion_before_breeding(self, monkeypatch):
+        exp = self.exp
+        calls = {'evaluate': 0, 'mate': 0}
+        evaluate_population, mate_batch = exp._evaluate_population, exp.mate_batch
+
+        def count_evaluate(*args, **kwargs):
+            calls['evaluate'] += 1
+            return evaluate_population(*args, **kwargs)
+
+        def count_mate(*args, **kwargs):
+            calls['mate'] += 1
+            return mate_batch(*args, **kwargs)
+
+        def constant_loss(population, *args, **kwargs):
+            return np.column_stack([np.arange(len(population)), np.zeros(len(population))])
+
+        monkeypatch.setattr(exp, '_evaluate_population', count_evaluate)
+        monkeypatch.setattr(exp, 'mate_batch', count_mate)
+        monkeypatch.setattr(exp, '_compute_loss', constant_loss)
+        monkeypatch.setattr(exp, '_predict_fn_custom', lambda to_pred, desired_class: [desired_class] * len(to_pred))
+        self._generate(n_jobs=1)
+        assert calls == {'evaluate': 6, 'mate': 5}
+
+    # A missing penalty must fail instead of turning the conformance scores into NaN
+    def test_missing_conformance_penalty(self):
+        with pytest.raises(UserConfigValidationException):
+            self._generate(n_jobs=1, conformance_penalty=None)
+
+    # Without a penalty argument no penalty is applied
+    def test_default_conformance_penalty(self):
+        query_instance = self.dataset.iloc[[3]].drop(columns='label')
+        self.exp.data_interface.set_continuous_feature_indexes(query_instance)
+        result = self.exp._generate_counterfactuals(query_instance, 2, self.encoder, 'fake', model_path=self.model_path,
+                                                    random_seed=0, maxiterations=15, activity_origin_position=0,
+                                                    activity_origin_name='a1', verbose=False)
+        np.testing.assert_array_equal(result.final_cfs_df, self._generate(n_jobs=1, conformance_penalty=0.0).final_cfs_df)
+
+    # The vectorized positions and penalties against the per-case loop they replaced
+    @pytest.mark.parametrize(("activity_origin_position", "activity_origin_name"),
+                             [(0, 'a1'), (1, 'a2'), (-1, 'a3'), (0, 'a9')])
+    def test_conformance_rows_match_per_case_loop(self, conformance_population, activity_origin_position,
+                                                  activity_origin_name):
+        from declare4py.enums import TraceState
+
+        encoder = FakeEncoder()
+        scores, check_res = self.exp._compute_conformance_rows(conformance_population, encoder, FakeDeclare4Py(),
+                                                               activity_origin_position, activity_origin_name, 0.1)
+
+        event_log, long_df = self.exp._build_event_log(conformance_population, encoder)
+        d4py = FakeDeclare4Py()
+        d4py.load_xes_log(event_log)
+        expected_check_res = d4py.conformance_checking(consider_vacuity=False)
+        expected_scores = []
+        for case, checkers in expected_check_res.items():
+            satisfied = sum(checker.state != TraceState.VIOLATED for checker in checkers.values())
+            score = satisfied / len(checkers)
+            activities = long_df.loc[long_df['case:concept:name'] == case, 'concept:name'].tolist()
+            synth_position = activities.index(activity_origin_name) if activity_origin_name in activities else -1
+            if synth_position == activity_origin_position or synth_position == -1:
+                score -= 0.1
+            expected_scores.append(score)
+
+        assert list(check_res) == list(expected_check_res)
+        np.testing.assert_allclose(scores, expected_scores, rtol=1e-6)
+
+    # The cases are scored in one chunk per worker, with the case ids of the whole population
+    def test_compute_conformance_new_chunks(self, conformance_population):
+        expected_scores, expected_check_res = self.exp._compute_conformance_rows(
+            conformance_population, FakeEncoder(), FakeDeclare4Py(), 0, 'a1', 0.1)
+        self.exp.n_jobs = 2
+        scores, check_res = self.exp.compute_conformance_new(conformance_population, FakeEncoder(), FakeDeclare4Py(),
+                                                             0, 'a1', 0.1)
+        np.testing.assert_array_equal(scores, expected_scores)
+        assert list(check_res) == list(expected_check_res)
+
+    # Rows scored before come from the memo, with their case keys moved to the rows' new positions
+    def test_memoized_conformance_partial_hits(self, conformance_population):
+        encoder, d4py = FakeEncoder(), FakeDeclare4Py()
+        evaluated = []
+
+        def evaluate(population, *args):
+            evaluated.append(len(population))
+            return self.exp._compute_conformance_rows(population, *args)
+
+        self.exp._memoized_conformance(conformance_population[:20], encoder, d4py, 0, 'a1', 0.1, evaluate)
+        population = np.vstack([conformance_population[30:], conformance_population[15:5:-1]])
+        scores, check_res = self.exp._memoized_conformance(population, encoder, d4py, 0, 'a1', 0.1, evaluate)
+        expected_scores, expected_check_res = self.exp._compute_conformance_rows(
+            population, encoder, FakeDeclare4Py(), 0, 'a1', 0.1)
+
+        assert evaluated[-1] == len(conformance_population[30:])
+        np.testing.assert_array_equal(scores, expected_scores)
+        assert list(check_res) == list(expected_check_res)
+        for checkers, expected_checkers in zip(check_res.values(), expected_check_res.values()):
+            assert [checker.state for checker in checkers.values()] == \
+                [checker.state for checker in expected_checkers.values()]
+
+
+@pytest.mark.skipif(not _dist_numba.NUMBA_AVAILABLE, reason="numba is not installed")
+class TestDiceGeneticConformanceKernels:
+    @pytest.fixture(autouse=True)
+    def _initiate_exp_object(self, initialized_exp_object, conformance_population):
+        self.exp, self.desired_class = initialized_exp_object
+        self.population = conformance_population
+
+    def _numpy_fallback(self, monkeypatch, func, *args):
+        with monkeypatch.context() as patch:
+            patch.setattr(_dist_numba, 'NUMBA_AVAILABLE', False)
+            return func(*args)
+
+    # mixed_distance against the per-feature-kind distances of distance_mh
+    def test_mixed_distance(self, monkeypatch):
+        query_instance = self.exp.x1.reshape(1, -1)
+        expected = self._numpy_fallback(monkeypatch, self.exp.distance_mh, query_instance, self.population, None)
+        np.testing.assert_allclose(self.exp.distance_mh(query_instance, self.population, None), expected,
+                                   rtol=1e-5)
+
+    # hinge_loss, and proximity_sparsity over values that do not fit in int32, against the NumPy losses
+    @pytest.mark.parametrize("sparsity_weight", [0.0, 0.5])
+    def test_compute_loss(self, monkeypatch, sparsity_weight):
+        self.exp.sparsity_weight = sparsity_weight
+        expected = self._numpy_fallback(monkeypatch, self.exp._compute_loss, self.population, None,
+                                        self.desired_class, False)
+        expected_sparsity = self.exp.sparsity_loss
+        np.testing.assert_allclose(self.exp._compute_loss(self.population, None, self.desired_class, False),
+                                   expected, rtol=1e-5)
+        np.testing.assert_array_equal(self.exp.sparsity_loss, expected_sparsity)
+        if sparsity_weight > 0:
+            changed = np.trunc(self.population) != self.exp._x1_int
+            np.testing.assert_allclose(self.exp.sparsity_loss, changed.mean(axis=1))
+
+    def test_mad_cityblock(self, monkeypatch):
+        inv_mad = np.array([0.5, 2.0, 1.0, 1.0, 0.25])
+        query = np.ascontiguousarray(self.exp.x1, dtype=np.float64)
+        for row in self.population:
+            expected = self._numpy_fallback(monkeypatch, mad_cityblock_fast, row, query, inv_mad)
+            assert mad_cityblock_fast(row, query, inv_mad) == pytest.approx(expected)
+        expected = self._numpy_fallback(monkeypatch, mad_cityblock_batch, self.population, query, inv_mad)
+        np.testing.assert_allclose(mad_cityblock_batch(self.population, query, inv_mad), expected)
+
+
+# Constructor checks that do not need a declare model
+def _prefix_exp_object(dataset):
+    d = dice_ml.Data(dataframe=dataset, continuous_features=['age', 'hours'], outcome_name='label')
+    clf = RandomForestClassifier(n_estimators=2, random_state=0)
+    clf.fit(dataset.drop(columns='label'), dataset.label)
+    return DiceGeneticConformance(d, dice_ml.Model(model=clf, backend='sklearn'))
+
+
+def test_prefix_columns(conformance_dataset):
+    conformance_dataset.insert(3, 'prefix_10', 0)
+    exp = _prefix_exp_object(conformance_dataset)
+    assert exp._prefix_cols == ['prefix_1', 'prefix_2', 'prefix_10']
+    np.testing.assert_array_equal(exp._prefix_order, [1, 2, 10])
+
+    # as with pd.wide_to_long's \w+ suffix, a non-numeric suffix makes every suffix sort as a string
+    conformance_dataset.insert(2, 'prefix_len', 2)
+    exp = _prefix_exp_object(conformance_dataset)
+    assert exp._prefix_cols == ['prefix_1', 'prefix_10', 'prefix_2', 'prefix_len']
+
+
+# The numpy reshape against the pd.wide_to_long call and sort it replaced
+@pytest.mark.parametrize("extra_prefixes", [['prefix_10'], ['prefix_10', 'prefix_len']])
+def test_wide_to_long(conformance_dataset, extra_prefixes):
+    for ix, column in enumerate(extra_prefixes):
+        conformance_dataset.insert(2 + ix, column, ix)
+    exp = _prefix_exp_object(conformance_dataset)
+    wide_df = conformance_dataset.drop(columns='label').iloc[:6].astype(str)
+    wide_df.insert(loc=0, column='Case ID', value=np.arange(len(wide_df)) + 1)
+    wide_df.insert(loc=1, column='label', value=1)
+
+    expected = pd.wide_to_long(wide_df, stubnames=['prefix'], i='Case ID', j='order', sep='_', suffix=r'\w+')
+    expected = expected.sort_values(['Case ID', 'order']).reset_index(drop=False)
+    # wide_to_long orders the other columns arbitrarily
+    pd.testing.assert_frame_equal(exp._wide_to_long(wide_df), expected, check_like=True)
+
+
+# The log builder against pm4py's own conversion, with interleaved cases and missing attribute values
+def test_event_log_matches_pm4py():
+    pm4py = pytest.importorskip("pm4py")
+    long_df = pd.DataFrame({
+        'case:concept:name': ['1', '2', '1', '2', '3'],
+        'case:label': ['true', np.nan, 'true', np.nan, 'false'],
+        'concept:name': ['a1', 'a2', 'a3', 'a1', 'a2'],
+        'time:timestamp': pd.date_range('2011-01-01', periods=5, freq='h'),
+        'hours': [1.5, np.nan, 2.0, 3.5, np.nan]})
+
+    def traces(event_log):
+        return [(trace.attributes, [dict(event) for event in trace]) for trace in event_log]
+    assert traces(_to_event_log(long_df)) == traces(pm4py.convert_to_event_log(long_df))
+
+
+class TestDiceGeneticConformanceInitialization:
+    @pytest.fixture(autouse=True)
+    def _initiate_exp_object(self, initialized_exp_object):
+        self.exp, self.desired_class = initialized_exp_object
+
+    # The masked neighbour clipping against the per-element loop it replaced: a neighbour value out of range
+    # falls back to the (valid) query value, and the features not to vary are taken from the query
+    def test_kd_init_clips_neighbours(self):
+        exp = self.exp
+        feature_names = exp.data_interface.feature_names
+        features_to_vary = ['age', 'prefix_1', 'color']
+        query_instance = np.asarray(exp.x1, dtype=float)
+        neighbours = exp.data_interface.data_df[feature_names].iloc[:10].astype(float)
+        neighbours.iloc[:3, feature_names.index('age')] = 1000
+        neighbours.iloc[3:5, feature_names.index('prefix_1')] = 99
+        exp.do_KD_init(features_to_vary, query_instance, neighbours, self.desired_class, None)
+
+        expected = []
+        for _, neighbour in neighbours.iterrows():
+            one_init = query_instance.copy()
+            for jx, feature in enumerate(feature_names):
+                if feature not in features_to_vary:
+                    continue
+                if feature in exp.data_interface.continuous_feature_names:
+                    valid = exp.feature_range[feature][0] <= neighbour[feature] <= exp.feature_range[feature][1]
+                else:
+                    valid = neighbour[feature] in np.asarray(exp.feature_range[feature], dtype=float)
+                if valid:
+                    one_init[jx] = neighbour[feature]
+            expected.append(tuple(one_init))
+
+        assert exp.cfs.shape == (exp.population_size, len(feature_names))
+        assert set(expected) <= set(map(tuple, exp.cfs))
+
+    # The initial population must survive the generations written to the population buffer
+    @pytest.mark.parametrize("initialization", ['kdtree', 'random'])
+    def test_initial_population_not_in_buffer(self, initialization):
+        exp = self.exp
+        feature_names = exp.data_interface.feature_names
+        query_instance = np.asarray(exp.x1, dtype=float).reshape(1, -1)
+        exp.do_cf_initializations(2, initialization, 'DiverseCF', feature_names, None, self.desired_class,
+                                  query_instance, exp._encode_dummies(exp.data_interface.prepare_query_instance(
+                                      pd.DataFrame(query_instance, columns=feature_names))), False)
+        assert not np.shares_memory(exp.cfs, exp._pop_buffer)
+
+    # A random initialization batch is larger than the population; it must not flush the score cache
+    def test_random_init_batch_stays_cached(self, monkeypatch):
+        exp = self.exp
+        exp._scores_cache.clear()
+        exp._accept_rate_estimate = 1 / exp._max_init_oversampling
+        population = exp.do_random_init(exp.population_size, exp.data_interface.feature_names, exp.x1,
+                                        self.desired_class, None).copy()
+        assert len(exp._scores_cache) > exp.population_size
+
+        def fail(*args, **kwargs):
+            raise AssertionError('the model was called on a cached row')
+        monkeypatch.setattr(exp, '_predict_scores_from_array', fail)
+        exp._predict_scores_cached(population)
+
+    # The weights list is cached by value; a string other than inverse_mad leaves every feature unweighted
+    def test_feature_weights_cache(self):
+        exp = self.exp
+        weights = {'age': 0.5, 'hours': 2.0}
+        exp.do_loss_initializations('hinge_loss', 'dpp_style:inverse_dist', dict(weights), encoding='label')
+        first = exp.feature_weights_list[0]
+        exp.do_loss_initializations('hinge_loss', 'dpp_style:inverse_dist', dict(weights), encoding='label')
+        assert exp.feature_weights_list[0] is first
+
+        exp.feature_range = {feature: np.asarray(values, dtype=float) for feature, values in exp.feature_range.items()}
+        exp.do_loss_initializations('hinge_loss', 'dpp_style:inverse_dist', 'unweighted', encoding='label')
+        expected = [round(1 / exp.feature_range[feature].max(), 2) for feature in exp.data_interface.feature_names]
+        assert exp.feature_weights_list[0] == expected
+
+
+class TestDiceGeneticConformanceMating:
+    @pytest.fixture(autouse=True)
+    def _initiate_exp_object(self, initialized_exp_object):
+        self.exp, _ = initialized_exp_object
+
+    # Mutated continuous genes are drawn over the whole feature range, not pinned to its lower bound
+    @pytest.mark.parametrize("batch", [False, True])
+    def test_children_within_feature_range(self, batch):
+        exp = self.exp
+        feature_names = exp.data_interface.feature_names
+        parents = np.tile(np.asarray(exp.x1, dtype=float), (200, 1))
+        if batch:
+            children = exp.mate_batch(parents, parents, feature_names, exp.x1)
+        else:
+            children = np.array([exp.mate(k1, k2, feature_names, exp.x1) for k1, k2 in zip(parents, parents)])
+
+        for feature in exp.data_interface.continuous_feature_names:
+            lo, hi = exp.feature_range[feature][0], exp.feature_range[feature][1]
+            genes = children[:, feature_names.index(feature)]
+            assert np.all((genes >= lo) & (genes <= hi))
+            mutated = genes[genes != exp.x1[feature_names.index(feature)]]
+            assert len(mutated) > 0
+            assert np.any(mutated > lo)
+
+    # The masked copies take ~40% of the genes from each parent; the rest are mutations, with the features
+    # not to vary kept at the query value
+    def test_mate_batch_gene_selection(self):
+        exp = self.exp
+        feature_names = exp.data_interface.feature_names
+        features_to_vary = ['age', 'hours', 'prefix_1']
+        parents1 = np.full((500, len(feature_names)), -1.0)
+        parents2 = np.full((500, len(feature_names)), -2.0)
+        query_instance = np.asarray(exp.x1, dtype=float)
+        children = exp.mate_batch(parents1, parents2, features_to_vary, query_instance)
+
+        from_parent1, from_parent2 = children == -1.0, children == -2.0
+        assert abs(from_parent1.mean() - 0.4) < 0.03
+        assert abs(from_parent2.mean() - 0.4) < 0.03
+        for jx, feature in enumerate(feature_names):
+            mutated = children[~from_parent1[:, jx] & ~from_parent2[:, jx], jx]
+            if feature not in features_to_vary:
+                np.testing.assert_array_equal(mutated, query_instance[jx])
+            elif feature in exp.data_interface.continuous_feature_names:
+                assert np.all((mutated >= exp.feature_range[feature][0]) & (mutated <= exp.feature_range[feature][1]))
+            else:
+                assert np.all(np.isin(mutated, np.asarray(exp.feature_range[feature], dtype=float)))
+
+
+class TestDiceGeneticConformanceLabelDecoding:
+    @pytest.fixture(autouse=True)
+    def _initiate_exp_object(self, conformance_exp_object):
+        self.exp = conformance_exp_object
+        self.exp.labelencoder = {
+            'prefix_1': LabelEncoder().fit(['a0', 'a1', 'a2', 'a3']),
+            'prefix_2': LabelEncoder().fit(['a0', 'a1', 'a2', 'a3', 'a4']),
+            'color': LabelEncoder().fit(['blue', 'green', 'red'])}
+
+    # The column-wise table lookups against the per-row inverse_transform loop they replaced
+    def test_label_decode(self, conformance_dataset):
+        exp = self.exp
+        feature_names = exp.data_interface.feature_names
+        labelled_input = conformance_dataset[feature_names].iloc[:20].to_numpy(dtype=np.float64)
+        expected = []
+        for row in labelled_input:
+            decoded = {}
+            for feature, value in zip(feature_names, row):
+                if feature in exp.data_interface.categorical_feature_names:
+                    decoded[feature] = exp.labelencoder[feature].inverse_transform(np.array([value], dtype=np.int32))[0]
+                else:
+                    decoded[feature] = value
+            expected.append(decoded)
+        expected = pd.DataFrame(expected, columns=feature_names)
+
+        pd.testing.assert_frame_equal(exp.label_decode(labelled_input), expected)
+        pd.testing.assert_frame_equal(exp.label_decode(labelled_input[0]), expected.iloc[[0]])
+
+    # Labels out of the range of the encoder fail like inverse_transform, negative ones included
+    @pytest.mark.parametrize("label", [-1, 3])
+    def test_label_decode_unseen_label(self, conformance_dataset, label):
+        labelled_input = conformance_dataset[self.exp.data_interface.feature_names].iloc[:5].to_numpy(dtype=np.float64)
+        labelled_input[2, self.exp.data_interface.feature_names.index('color')] = label
+        with pytest.raises(ValueError, match='previously unseen labels'):
+            self.exp.label_decode(labelled_input)